@@ -1,5 +1,5 @@
 from django.contrib import admin
-from chat.models import Message, UserAccount
+from chat.models import Message, UserAccount, UsageRollup
 
 # Register your models here.
 
@@ -21,3 +21,24 @@ class UserAccountAdmin(admin.ModelAdmin):
 
     def has_change_permission(self, request, obj=None):
         return False
+
+
+@admin.register(UsageRollup)
+class UsageRollupAdmin(admin.ModelAdmin):
+    list_display = (
+        'day',
+        'model',
+        'user_type',
+        'llm_messages',
+        'qcmd_messages',
+        'prompt_tokens',
+        'completion_tokens',
+    )
+    list_filter = ('model', 'user_type')
+    date_hierarchy = 'day'
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_add_permission(self, request):
+        return False
@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        from django.conf import settings
+        from django.db.backends.signals import connection_created
+        from .core.db import configure_sqlite
+
+        if settings.SQLITE_PRODUCTION:
+            connection_created.connect(configure_sqlite)
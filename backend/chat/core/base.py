@@ -1,9 +1,11 @@
 from ..models import UserPreference, Session, SessionContext, Message
 from .errors import ChatError
 from .utils import senword_detector, senword_detector_strict
-from .gpt import GPTConnectionFactory
+from .gpt import GPTConnectionFactory, DeltaCallback
 from .configs import (
     OPENAI_MOCK,
+    COALESCE_REQUESTS,
+    COMPLETION_CACHE,
     SYSTEM_ROLE,
     SYSTEM_ROLE_STRICT,
     SYSTEM_ROLE_FRIENDLY_TL,
@@ -11,11 +13,21 @@ from .configs import (
     ModelCap,
 )
 from .plugin import check_and_exec_qcmds, PluginResponse, fc_get_specs
+from .metrics import HANDLE_MESSAGE_SECONDS, TOKENS
+from .quota import QuotaReservation
+from .tokens import (
+    MESSAGE_OVERHEAD,
+    REPLY_PRIMING,
+    IMAGE_TOKENS,
+    estimate_text_tokens,
+    estimate_content_tokens,
+    truncate_text,
+)
 from .plugins.fc import FCSpec
 
 from django.contrib.auth.models import User
 from django.utils.timezone import datetime
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Union, Optional
 
 import logging
@@ -35,7 +47,7 @@ async def check_and_handle_qcmds(msg: str) -> Union[Message, None]:
     Error:
         ChatError: 若出错则抛出
     """
-    resp: PluginResponse = check_and_exec_qcmds(msg)
+    resp: PluginResponse = await check_and_exec_qcmds(msg)
 
     if resp.triggered:
         if resp.success:
@@ -61,6 +73,9 @@ class GPTContext:
 class GPTPermission:
     student: bool
     available: bool
+    user_type: str = ""
+    # 学生已占用的当日额度，回复保存后确认，失败时释放
+    reservation: Optional[QuotaReservation] = None
 
 
 @dataclass
@@ -71,6 +86,8 @@ class GPTRequest:
     context: GPTContext
     plugins: list[str]
     preference: UserPreference
+    # 本次估算了token数的历史消息，随本轮消息一起保存
+    counted_history: list[Message] = field(default_factory=list)
 
 
 class InputListContentFactory:
@@ -113,6 +130,56 @@ class InputListContentFactory:
             return text
 
 
+# 历史消息被截断后至少保留的token数，不足则直接丢弃
+MIN_TRUNCATED_TOKENS = 64
+
+
+def __fit_history(
+    history: list[Message], model_cap: ModelCap, budget: int
+) -> tuple[list[dict], list[Message]]:
+    """从新到旧在token预算内附带历史消息，放不下的第一条截断后保留末尾部分
+
+    Returns:
+        fitted: 附带的历史消息
+        uncounted: 本次估算了token数的消息（尚未保存）
+    """
+    role = ["assistant", "user"]
+    builder = InputListContentFactory(model_cap)
+
+    # 每条消息的token数只估算一次，回复保存时一并写回
+    uncounted = [message for message in history if message.content_tokens is None]
+    for message in uncounted:
+        message.content_tokens = estimate_text_tokens(message.content)
+
+    fitted = []
+    for message in reversed(history):
+        images = len(message.blobs) if model_cap.image_support else 0
+        cost = message.content_tokens + MESSAGE_OVERHEAD + images * IMAGE_TOKENS
+
+        if cost <= budget:
+            fitted.append(
+                {
+                    "role": role[message.sender],
+                    "content": builder.set_message(message).build(),
+                }
+            )
+            budget -= cost
+            continue
+
+        if images == 0 and budget - MESSAGE_OVERHEAD >= MIN_TRUNCATED_TOKENS:
+            fitted.append(
+                {
+                    "role": role[message.sender],
+                    "content": truncate_text(
+                        message.content, budget - MESSAGE_OVERHEAD
+                    ),
+                }
+            )
+        break
+
+    return fitted[::-1], uncounted
+
+
 def build_fcspec(id: str):
     try:
         return fc_get_specs(id)
@@ -143,41 +210,53 @@ async def __build_input_list(request: GPTRequest, session: Session):
     )
 
     # 构造输入
-    role = ["assistant", "user"]
     SYSTEM_PREAMBLE = SYSTEM_ROLE_STRICT if use_strict_prompt else SYSTEM_ROLE
 
     if preference.use_friendly_sysprompt:
         SYSTEM_PREAMBLE += SYSTEM_ROLE_FRIENDLY_TL.format(str(request.user.username))
 
     try:
-        builder = InputListContentFactory(CHAT_MODELS[request.model_engine])
+        model_cap = CHAT_MODELS[request.model_engine]
     except KeyError:
         raise ChatError("无模型匹配")
 
-    input_list = [
-        {
-            "role": "system",
-            "content": SYSTEM_PREAMBLE,
-        },
-    ]
-    input_list.extend(
-        [
-            {
-                "role": role[message.sender],
-                "content": builder.set_message(message).build(),
-            }
-            for message in history
-        ]
+    system_message = {
+        "role": "system",
+        "content": SYSTEM_PREAMBLE,
+    }
+    user_message = {
+        "role": "user",
+        "content": InputListContentFactory(model_cap).set_context(context).build(),
+    }
+
+    # 在发出请求前按上下文窗口裁剪历史消息
+    budget = (
+        model_cap.context_window
+        - max(model_cap.reserved_output, preference.max_tokens)
+        - REPLY_PRIMING
+        - estimate_content_tokens(system_message["content"])
+        - estimate_content_tokens(user_message["content"])
     )
+    if budget < 0:
+        raise ChatError("请求失败，输入过长，请缩短输入", status=400)
 
-    input_list.append({"role": "user", "content": builder.set_context(context).build()})
+    fitted, request.counted_history = __fit_history(history, model_cap, budget)
+    input_list = [system_message]
+    input_list.extend(fitted)
+    input_list.append(user_message)
 
     return input_list
 
 
+def __model_label(model_engine: str) -> str:
+    """指标中的模型标签：model_engine 由客户端提供，未配置的模型统一记为 unknown"""
+    return model_engine if model_engine in CHAT_MODELS else "unknown"
+
+
 async def handle_message(
     session: Session,
     request: GPTRequest,
+    on_delta: Optional[DeltaCallback] = None,
 ) -> Message:
     """消息处理的主入口
 
@@ -186,6 +265,7 @@ async def handle_message(
         message: 用户输入的消息
         selected_model: 用户选择的模型
         session: 当前会话
+        on_delta: 若提供则流式请求，逐段回调生成的增量文本
 
     Returns:
         response: Message对象
@@ -193,11 +273,60 @@ async def handle_message(
     Error:
         ChatError: 若出错则抛出并附上对应的status code
     """
+    model = __model_label(request.model_engine)
+    with HANDLE_MESSAGE_SECONDS.time(model=model) as timer:
+        response = await __handle_message(session, request, on_delta)
+        if response.flag_qcmd:
+            timer.labels["outcome"] = "qcmd"
+        else:
+            TOKENS.inc(response.prompt_tokens, model=model, kind="prompt")
+            TOKENS.inc(response.completion_tokens, model=model, kind="completion")
+    return response
+
+
+async def handle_qcmd(msg: str, model_engine: str) -> Optional[Message]:
+    """快捷命令的入口，在读取历史消息、检查额度之前调用
+
+    Args:
+        msg: 用户输入的消息
+        model_engine: 用户选择的模型，仅用于统计
+    Returns:
+        message: 命令匹配时返回Message对象，否则为None
+    Error:
+        ChatError: 命令执行失败时抛出
+    """
+    if not msg.startswith("/"):
+        return None
+
+    start = time.monotonic()
+    try:
+        response = await check_and_handle_qcmds(msg)
+    except ChatError:
+        HANDLE_MESSAGE_SECONDS.observe(
+            time.monotonic() - start,
+            model=__model_label(model_engine),
+            outcome="error",
+        )
+        raise
+    if response is not None:
+        HANDLE_MESSAGE_SECONDS.observe(
+            time.monotonic() - start,
+            model=__model_label(model_engine),
+            outcome="qcmd",
+        )
+    return response
+
+
+async def __handle_message(
+    session: Session,
+    request: GPTRequest,
+    on_delta: Optional[DeltaCallback],
+) -> Message:
     context = request.context
     preference = request.preference
     permission = request.permission
 
-    # 快捷命令
+    # 快捷命令（新消息已由 handle_qcmd 处理，这里处理重新生成）
     if context.msg[0] == "/":
         resp = await check_and_handle_qcmds(context.msg)
         if resp is not None:
@@ -222,6 +351,9 @@ async def handle_message(
         GPTConnectionFactory()
         .model_engine(request.model_engine)
         .mock(OPENAI_MOCK)
+        .coalesce(COALESCE_REQUESTS)
+        .cache(COMPLETION_CACHE)
+        .regen(context.regen)
         .build()
     )
 
@@ -230,6 +362,7 @@ async def handle_message(
         preference.temperature,
         preference.max_tokens,
         plugins,
+        on_delta,
     )
 
     # 输出关键词检测
@@ -247,7 +380,14 @@ async def summary_title(msg: str) -> tuple[bool, str]:
         {"role": "user", "content": msg + "\n用小于五个词概括上述文字"},
     ]
     try:
-        connection = GPTConnectionFactory().model_engine().mock(OPENAI_MOCK).build()
+        connection = (
+            GPTConnectionFactory()
+            .model_engine()
+            .mock(OPENAI_MOCK)
+            .coalesce(COALESCE_REQUESTS)
+            .cache(COMPLETION_CACHE)
+            .build()
+        )
         response = await connection.interact(
             msg=input_list,
             max_tokens=20,
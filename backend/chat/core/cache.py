@@ -0,0 +1,86 @@
+from ..models.message import Message
+from .plugins.fc import FCSpec
+
+from collections import OrderedDict
+from dataclasses import asdict
+from typing import Optional
+import hashlib
+import json
+import time
+
+
+def request_fingerprint(
+    model_engine: str,
+    msg: list,
+    temperature: float,
+    max_tokens: int,
+    selected_plugins: list[FCSpec],
+) -> str:
+    """计算一次请求的稳定哈希，相同的输入得到相同的结果"""
+    payload = {
+        "model": model_engine,
+        "msg": msg,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "tools": [
+            asdict(fc_spec.definition)
+            for fc_spec in sorted(selected_plugins, key=lambda x: x.definition.name)
+        ],
+    }
+    return hashlib.sha256(
+        json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()
+    ).hexdigest()
+
+
+def copy_reply(message: Message) -> Message:
+    """复制一条回复用于另一个请求，复用的回复不计上游token用量"""
+    return Message(
+        sender=0,
+        flag_qcmd=False,
+        content=message.content,
+        interrupted=message.interrupted,
+        plugin_group=message.plugin_group,
+        use_model=message.use_model,
+    )
+
+
+class CompletionCache:
+    """带TTL的LRU回复缓存"""
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__entries: OrderedDict[str, tuple[float, Message]] = OrderedDict()
+
+    def get(self, key: str) -> Optional[Message]:
+        entry = self.__entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.__entries[key]
+            self.misses += 1
+            return None
+
+        self.__entries.move_to_end(key)
+        self.hits += 1
+        return copy_reply(entry[1])
+
+    def set(self, key: str, message: Message):
+        self.__entries[key] = (time.monotonic() + self.ttl, copy_reply(message))
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.size:
+            self.__entries.popitem(last=False)
+
+    def clear(self):
+        self.__entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.__entries),
+            "capacity": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
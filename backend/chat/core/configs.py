@@ -1,13 +1,53 @@
 from dataclasses import dataclass
+from typing import Optional
 import os
 
 # 学生账户每日限制
 STUDENT_LIMIT = 20
+# 用量计数使用的缓存（settings.CACHES），以及写回数据库的间隔（秒）
+QUOTA_CACHE = os.environ.get("QUOTA_CACHE", "quota")
+QUOTA_FLUSH_INTERVAL = float(os.environ.get("QUOTA_FLUSH_INTERVAL", 5))
+# 服务进程数（gunicorn/uvicorn 约定的 WEB_CONCURRENCY），大于1时用量计数须使用共享缓存
+SERVER_WORKERS = int(os.environ.get("WEB_CONCURRENCY", 1))
+
+# 用户身份与偏好设置的跨请求缓存（settings.CACHES）及缓存时间（秒），修改偏好设置时失效。
+# 多进程部署时应使用共享后端，否则其他进程最多在 TTL 内读到旧值
+USER_CONTEXT_CACHE = os.environ.get("USER_CONTEXT_CACHE", "default")
+USER_CONTEXT_TTL = int(os.environ.get("USER_CONTEXT_TTL", 30))
 
 # OpenAI Key
 OPENAI_KEY = os.environ.get("OPENAI_KEY", None)
 OPENAI_ORGANIZATION = os.environ.get("OPENAI_ORGANIZATION", None)
 OPENAI_MOCK = False
+# 模拟上游的行为，见 chat/core/mock.py 中的 MOCK_PROFILES
+OPENAI_MOCK_PROFILE = os.environ.get("OPENAI_MOCK_PROFILE", "instant")
+
+# 抓取 /api/metrics/ 使用的Bearer token，未配置时仅管理员可访问
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", None)
+
+# 每个provider的熔断器：连续失败次数阈值与冷却时间（秒）
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", 5))
+BREAKER_RECOVERY_TIME = float(os.environ.get("BREAKER_RECOVERY_TIME", 30))
+
+# 每个provider的自适应并发上限（AIMD）
+LIMITER_INITIAL = float(os.environ.get("LIMITER_INITIAL", 64))
+LIMITER_MIN = float(os.environ.get("LIMITER_MIN", 4))
+LIMITER_MAX = float(os.environ.get("LIMITER_MAX", 512))
+
+# 合并相同的进行中请求，只向上游发出一次
+COALESCE_REQUESTS = True
+
+# 回复缓存：仅缓存temperature不高于阈值（即输出近似确定）的请求
+COMPLETION_CACHE = True
+COMPLETION_CACHE_SIZE = int(os.environ.get("COMPLETION_CACHE_SIZE", 1024))
+COMPLETION_CACHE_TTL = float(os.environ.get("COMPLETION_CACHE_TTL", 600))
+COMPLETION_CACHE_MAX_TEMPERATURE = float(
+    os.environ.get("COMPLETION_CACHE_MAX_TEMPERATURE", 0.2)
+)
+
+# 增量同步返回的 watermark 比读取时刻提前的秒数：修改时间在事务内生成，
+# 提交可能晚于读取，提前量应大于写事务的最长耗时（含 SQLite busy_timeout）
+SYNC_WATERMARK_LAG = float(os.environ.get("SYNC_WATERMARK_LAG", 30))
 
 # Azure OpenAI Key
 AZURE_OPENAI_KEY = os.environ.get("AZURE_OPENAI_KEY", None)
@@ -18,6 +58,45 @@ IDEALAB_KEY = os.environ.get("IDEALAB_KEY", None)
 IDEALAB_ENDPOINT = os.environ.get("IDEALAB_ENDPOINT", None)
 
 
+@dataclass(frozen=True)
+class ProviderConfig:
+    api_key: Optional[str]
+    base_url: Optional[str]
+    organization: Optional[str] = None
+    # 非空时使用Azure OpenAI客户端
+    api_version: Optional[str] = None
+    # 流式输出时是否请求末尾的usage统计（stream_options）
+    stream_usage: bool = True
+
+
+# 上游API服务商，ModelCap.provider 需为其中之一
+PROVIDERS = {
+    "azure": ProviderConfig(
+        api_key=AZURE_OPENAI_KEY,
+        base_url=AZURE_OPENAI_ENDPOINT,
+        api_version="2023-07-01-preview",
+        stream_usage=False,
+    ),
+    "openai": ProviderConfig(
+        api_key=OPENAI_KEY,
+        base_url="https://api.openai.com/v1",
+        organization=OPENAI_ORGANIZATION,
+    ),
+    "idealab": ProviderConfig(
+        api_key=IDEALAB_KEY,
+        base_url=IDEALAB_ENDPOINT,
+    ),
+}
+
+# 上游API连接池（所有provider共用一个keep-alive连接池）
+OPENAI_PROXY = os.environ.get("OPENAI_PROXY", None)
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", 60))
+OPENAI_CONNECT_TIMEOUT = float(os.environ.get("OPENAI_CONNECT_TIMEOUT", 5))
+OPENAI_POOL_MAX_CONNECTIONS = int(os.environ.get("OPENAI_POOL_MAX_CONNECTIONS", 500))
+OPENAI_POOL_MAX_KEEPALIVE = int(os.environ.get("OPENAI_POOL_MAX_KEEPALIVE", 100))
+OPENAI_KEEPALIVE_EXPIRY = float(os.environ.get("OPENAI_KEEPALIVE_EXPIRY", 60))
+
+
 # 系统提示（上传OpenAI时调用）
 SYSTEM_ROLE = "You are a helpful assistant."
 
@@ -27,6 +106,41 @@ SYSTEM_ROLE_FRIENDLY_TL = " The human you are talking to is named '{0}' and plea
 
 FC_API_ENDPOINT = os.environ.get("FC_API_ENDPOINT", "")
 
+# 插件后端连接池（进程内共享）
+FC_POOL_LIMIT = int(os.environ.get("FC_POOL_LIMIT", 100))
+FC_POOL_LIMIT_PER_HOST = int(os.environ.get("FC_POOL_LIMIT_PER_HOST", 50))
+FC_KEEPALIVE_TIMEOUT = float(os.environ.get("FC_KEEPALIVE_TIMEOUT", 30))
+FC_CONNECT_TIMEOUT = float(os.environ.get("FC_CONNECT_TIMEOUT", 3))
+FC_READ_TIMEOUT = float(os.environ.get("FC_READ_TIMEOUT", 20))
+
+# 快捷命令访问校园接口的连接池与超时（秒），总超时同时限制旧式同步插件
+QCMD_POOL_LIMIT = int(os.environ.get("QCMD_POOL_LIMIT", 20))
+QCMD_CONNECT_TIMEOUT = float(os.environ.get("QCMD_CONNECT_TIMEOUT", 2))
+QCMD_READ_TIMEOUT = float(os.environ.get("QCMD_READ_TIMEOUT", 4))
+QCMD_TIMEOUT = float(os.environ.get("QCMD_TIMEOUT", 6))
+# 校园数据缓存（Django缓存别名）：ttl 秒内直接使用，之后后台刷新；
+# 上游出错时旧数据最多保留 max_stale 秒
+QCMD_CACHE = os.environ.get("QCMD_CACHE", "qcmd")
+QCMD_CACHE_TTL = float(os.environ.get("QCMD_CACHE_TTL", 60))
+QCMD_CACHE_MAX_STALE = float(os.environ.get("QCMD_CACHE_MAX_STALE", 3600))
+# 运行旧式同步插件的线程数
+QCMD_SYNC_WORKERS = int(os.environ.get("QCMD_SYNC_WORKERS", 4))
+
+# 单次回复中插件调用的最大轮数（每轮可并发执行多个函数调用）
+FC_MAX_ROUNDS = int(os.environ.get("FC_MAX_ROUNDS", 3))
+
+
+# 等价后端之间的路由：滑动窗口的大小、时长（秒），以及错误率折算的延迟惩罚（秒）
+ROUTING_WINDOW_SIZE = int(os.environ.get("ROUTING_WINDOW_SIZE", 50))
+ROUTING_WINDOW_TIME = float(os.environ.get("ROUTING_WINDOW_TIME", 300))
+ROUTING_ERROR_PENALTY = float(os.environ.get("ROUTING_ERROR_PENALTY", 30))
+
+
+@dataclass(frozen=True)
+class ModelBackend:
+    provider: str
+    model_called: str
+
 
 @dataclass
 class ModelCap:
@@ -36,10 +150,24 @@ class ModelCap:
     image_support: bool
     provider: str
     model_called: str
+    # 上下文窗口（token），以及为输出预留的最少token数
+    context_window: int = 128000
+    reserved_output: int = 1000
+    # 与 provider/model_called 等价的备选后端，按延迟与错误率路由并自动切换
+    alternatives: tuple[ModelBackend, ...] = ()
+
+    def backends(self) -> tuple[ModelBackend, ...]:
+        return (ModelBackend(self.provider, self.model_called),) + self.alternatives
 
     @staticmethod
     def dict_factory(cap) -> dict:
-        omit_fields = ("provider", "model_called")
+        omit_fields = (
+            "provider",
+            "model_called",
+            "context_window",
+            "reserved_output",
+            "alternatives",
+        )
         return {k: v for k, v in cap if k not in omit_fields}
 
 
@@ -75,6 +203,7 @@ CHAT_MODELS = {
         image_support=True,
         provider="idealab",
         model_called="gpt-4o-0513",
+        # alternatives=(ModelBackend(provider="azure", model_called="gpt-4o"),),
     ),
     "Idealab Qwen Max": ModelCap(
         label="千问VL Max",
@@ -83,6 +212,7 @@ CHAT_MODELS = {
         image_support=True,
         provider="idealab",
         model_called="qwen-vl-max",
+        context_window=32000,
     ),
     # "LLAMA 2": ModelCap(
     #     label="交我算",
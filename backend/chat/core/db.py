@@ -0,0 +1,54 @@
+# SQLite生产模式（settings.SQLITE_PRODUCTION）：
+# - 每个连接启用WAL并调整pragma，读写互不阻塞
+# - 聊天相关的写操作由单一线程串行执行，避免多个写者争抢锁（database is locked）
+# - 读操作使用 thread_sensitive=False 在线程池中执行，不再排在写操作之后
+# 未开启时与 sync_to_async 的默认行为一致
+from django.conf import settings
+from asgiref.sync import sync_to_async
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, TypeVar
+import functools
+import asyncio
+
+T = TypeVar("T")
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    # WAL下NORMAL只在掉电时可能丢失最近的事务，不会损坏数据库
+    "PRAGMA synchronous=NORMAL",
+    # 负数单位为KiB
+    "PRAGMA cache_size=-32000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+)
+
+__writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """connection_created 信号处理：为新的SQLite连接设置pragma"""
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+
+
+def db_writer(func: Callable[..., T]) -> Callable[..., Awaitable[T]]:
+    """与 sync_to_async 用法相同，生产模式下在唯一的写线程中执行"""
+    if not settings.SQLITE_PRODUCTION:
+        return sync_to_async(func)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            __writer, functools.partial(func, *args, **kwargs)
+        )
+
+    return wrapper
+
+
+def db_reader(func: Callable[..., T]) -> Callable[..., Awaitable[T]]:
+    """与 sync_to_async 用法相同，生产模式下在线程池中并发执行"""
+    return sync_to_async(func, thread_sensitive=not settings.SQLITE_PRODUCTION)
@@ -1,23 +1,233 @@
 from ..models.message import Message
-from .testdata.lipsum import LIPSUM
+from .mock import MOCK_PROFILES, MockProfile, plan_completion
 from .plugins.fc import FCSpec
 from .errors import ChatError
+from .cache import CompletionCache, copy_reply, request_fingerprint
+from .singleflight import SingleFlight
+from .resilience import (
+    ProviderGuard,
+    ProviderGuards,
+    ProviderUnavailable,
+    parse_retry_after,
+)
+from .routing import BackendRouter
+from .metrics import (
+    INTERACT_SECONDS,
+    UPSTREAM_ERRORS,
+    UPSTREAM_RETRIES,
+    UPSTREAM_SECONDS,
+    UPSTREAM_TTFT_SECONDS,
+)
 from .configs import *
 
 from typing_extensions import Self
-from typing import Awaitable, Callable, Union
+from typing import Awaitable, Callable, Mapping, Optional, Union
+from types import MappingProxyType
 from dataclasses import asdict, dataclass
 from abc import ABC, abstractmethod
 import functools
 import tenacity
 import logging
+import asyncio
+import time
 import dacite
 import openai
-import os
+import httpx
 
 logger = logging.getLogger(__name__)
 
-openai.proxy = os.getenv("OPENAI_PROXY", None)
+
+class ProviderRegistry:
+    """进程级的上游客户端注册表
+
+    按 ModelCap.provider 索引、预先配置好的异步客户端，构建一次后由所有
+    GPTConnection 共享，请求过程中不再修改任何配置。所有客户端共用同一个
+    keep-alive连接池；连接池与创建它的事件循环绑定，事件循环变化时整体重建，
+    并关闭被替换的连接池（各客户端共用它，关闭后即释放全部连接）。
+    """
+
+    def __init__(self, providers: Mapping[str, ProviderConfig]):
+        self.__providers = MappingProxyType(dict(providers))
+        self.__clients: Mapping[str, openai.AsyncOpenAI] = MappingProxyType({})
+        self.__http_client: Optional[httpx.AsyncClient] = None
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+        self.__closing: set[asyncio.Task] = set()
+
+        for cap in CHAT_MODELS.values():
+            for backend in cap.backends():
+                if backend.provider not in self.__providers:
+                    logger.warning(
+                        "Provider {0} is not registered".format(backend.provider)
+                    )
+
+    @staticmethod
+    def __build_http_client() -> httpx.AsyncClient:
+        return openai.DefaultAsyncHttpxClient(
+            proxy=OPENAI_PROXY,
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=OPENAI_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_POOL_MAX_KEEPALIVE,
+                keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+            ),
+        )
+
+    @staticmethod
+    def __build_client(
+        config: ProviderConfig, http_client: httpx.AsyncClient
+    ) -> openai.AsyncOpenAI:
+        if config.api_version is not None:
+            return openai.AsyncAzureOpenAI(
+                api_key=config.api_key,
+                azure_endpoint=config.base_url,
+                api_version=config.api_version,
+                max_retries=0,
+                http_client=http_client,
+            )
+        return openai.AsyncOpenAI(
+            api_key=config.api_key,
+            organization=config.organization,
+            base_url=config.base_url,
+            max_retries=0,
+            http_client=http_client,
+        )
+
+    def __build(self, loop: Optional[asyncio.AbstractEventLoop]):
+        if self.__http_client is not None:
+            self.__discard(self.__http_client, self.__loop, loop)
+
+        http_client = self.__build_http_client()
+        clients = {}
+        for name, config in self.__providers.items():
+            try:
+                clients[name] = self.__build_client(config, http_client)
+            except openai.OpenAIError as e:
+                logger.info("Provider {0} is not configured: {1}".format(name, e))
+
+        self.__http_client = http_client
+        self.__clients = MappingProxyType(clients)
+        self.__loop = loop
+
+    def __discard(
+        self,
+        http_client: httpx.AsyncClient,
+        old_loop: Optional[asyncio.AbstractEventLoop],
+        loop: Optional[asyncio.AbstractEventLoop],
+    ):
+        """关闭被替换的连接池：旧事件循环仍在运行时在其中关闭，否则在当前事件循环中关闭"""
+        if old_loop is not None and old_loop is not loop and old_loop.is_running():
+            asyncio.run_coroutine_threadsafe(
+                self.__aclose_quietly(http_client), old_loop
+            )
+        elif loop is not None:
+            task = loop.create_task(self.__aclose_quietly(http_client))
+            self.__closing.add(task)
+            task.add_done_callback(self.__closing.discard)
+
+    @staticmethod
+    async def __aclose_quietly(http_client: httpx.AsyncClient):
+        try:
+            await http_client.aclose()
+        except Exception as e:
+            # 旧事件循环已关闭时部分连接无法正常关闭
+            logger.debug("Failed to close replaced http client: {0}".format(e))
+
+    def __ensure_built(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        if self.__http_client is None:
+            self.__build(loop)
+        elif loop is not None and loop is not self.__loop:
+            if self.__loop is None:
+                self.__loop = loop
+            else:
+                self.__build(loop)
+
+    def get(self, provider: str) -> openai.AsyncOpenAI:
+        self.__ensure_built()
+        try:
+            return self.__clients[provider]
+        except KeyError:
+            raise ProviderUnavailable("模型服务未配置，请联系管理员")
+
+    async def warmup(self):
+        """启动时构建各provider的客户端并预先建立到上游的连接"""
+        self.__ensure_built()
+        assert self.__http_client is not None
+        providers = {
+            backend.provider
+            for cap in CHAT_MODELS.values()
+            for backend in cap.backends()
+        }
+        for provider in providers:
+            try:
+                client = self.get(provider)
+                await self.__http_client.head(str(client.base_url))
+            except Exception as e:
+                logger.info("Failed to warm up provider {0}: {1}".format(provider, e))
+
+    async def aclose(self):
+        """关闭当前及正在关闭的连接池（ASGI lifespan shutdown 时调用）"""
+        if self.__closing:
+            await asyncio.gather(*self.__closing, return_exceptions=True)
+        if self.__http_client is not None:
+            await self.__http_client.aclose()
+        self.__http_client = None
+        self.__clients = MappingProxyType({})
+        self.__loop = None
+
+
+provider_registry = ProviderRegistry(PROVIDERS)
+
+
+provider_guards = ProviderGuards(
+    failure_threshold=BREAKER_FAILURE_THRESHOLD,
+    recovery_time=BREAKER_RECOVERY_TIME,
+    initial_limit=LIMITER_INITIAL,
+    min_limit=LIMITER_MIN,
+    max_limit=LIMITER_MAX,
+)
+
+
+backend_router = BackendRouter(
+    window_size=ROUTING_WINDOW_SIZE,
+    window_time=ROUTING_WINDOW_TIME,
+    error_penalty=ROUTING_ERROR_PENALTY,
+)
+
+
+def is_failover_error(e: Exception) -> bool:
+    """连接错误、5xx或provider不可用时可切换到其他等价后端"""
+    if isinstance(e, ProviderUnavailable):
+        return True
+    if isinstance(e, openai.APIConnectionError):
+        return True
+    return isinstance(e, openai.APIStatusError) and e.status_code >= 500
+
+
+def classify_openai_error(e: openai.OpenAIError) -> tuple[str, Optional[float]]:
+    """将上游错误归类为熔断器与并发限制所用的结果"""
+    if isinstance(e, openai.APITimeoutError):
+        return ProviderGuard.OVERLOAD, None
+    if isinstance(e, openai.APIConnectionError):
+        return ProviderGuard.FAILURE, None
+    if isinstance(e, openai.APIStatusError):
+        retry_after = parse_retry_after(e.response.headers)
+        if e.status_code in (429, 503):
+            return ProviderGuard.OVERLOAD, retry_after
+        if e.status_code >= 500:
+            return ProviderGuard.FAILURE, retry_after
+    return ProviderGuard.IGNORE, None
+
+
+def error_class(e: BaseException) -> str:
+    """指标中使用的错误类别，包装过的上游错误取其原因"""
+    if isinstance(e, ChatError) and e.__cause__ is not None:
+        e = e.__cause__
+    return type(e).__name__
 
 
 @dataclass
@@ -27,6 +237,67 @@ class GPTUsage:
     total_tokens: int
 
 
+# 流式输出时接收增量文本的回调
+DeltaCallback = Callable[[str], Awaitable[None]]
+
+
+class StreamAccumulator:
+    """将流式返回的chunk拼接为与非流式接口一致的response字典"""
+
+    def __init__(self):
+        self.__content: list[str] = []
+        self.__tool_calls: dict[int, dict] = {}
+        self.__finish_reason: Optional[str] = None
+        self.__usage: Optional[dict] = None
+
+    def add(self, chunk: dict) -> str:
+        """合并一个chunk，返回其中的增量文本"""
+        if chunk.get("usage"):
+            self.__usage = chunk["usage"]
+
+        if not chunk.get("choices"):
+            return ""
+
+        choice = chunk["choices"][0]
+        if choice.get("finish_reason"):
+            self.__finish_reason = choice["finish_reason"]
+
+        delta = choice.get("delta") or {}
+        for tool_call in delta.get("tool_calls") or []:
+            merged = self.__tool_calls.setdefault(
+                tool_call.get("index", 0),
+                {"id": "", "type": "function", "function": {"name": "", "arguments": ""}},
+            )
+            merged["id"] += tool_call.get("id") or ""
+            function = tool_call.get("function") or {}
+            merged["function"]["name"] += function.get("name") or ""
+            merged["function"]["arguments"] += function.get("arguments") or ""
+
+        content = delta.get("content") or ""
+        self.__content.append(content)
+        return content
+
+    def to_dict(self) -> dict:
+        message: dict = {"role": "assistant", "content": "".join(self.__content)}
+        if self.__tool_calls:
+            message["tool_calls"] = [
+                self.__tool_calls[index] for index in sorted(self.__tool_calls)
+            ]
+
+        response: dict = {
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": self.__finish_reason or "stop",
+                    "message": message,
+                }
+            ]
+        }
+        if self.__usage:
+            response["usage"] = self.__usage
+        return response
+
+
 class FunctionCallAdapter:
     def __init__(
         self, model_engine: str, fc_map: dict, gpt: Callable[[list], Awaitable[dict]]
@@ -35,13 +306,14 @@ class FunctionCallAdapter:
         self.fc_map = fc_map
         self.gpt = gpt
 
-    async def __call__(self, msg: list, fc_response: dict) -> dict:
-        fc_completion: dict[str, str] = fc_response["choices"][0]["message"][
-            "tool_calls"
-        ][0]["function"]
+    async def __exec(self, tool_call: dict) -> dict:
+        fc_completion: dict[str, str] = tool_call["function"]
+
+        try:
+            fc = self.fc_map[fc_completion["name"]]
+        except KeyError:
+            raise ChatError("无插件匹配")
 
-        fc = self.fc_map[fc_completion["name"]]
-        fc_plugin_group = fc.group_id
         arguments = fc_completion["arguments"]
         try:
             fc_success, fc_content = await fc.exec(arguments)
@@ -51,17 +323,40 @@ class FunctionCallAdapter:
         if not fc_success:
             raise ChatError(fc_content)
 
-        else:
-            msg.append(
-                {
-                    "role": "function",
-                    "name": fc.definition.name,
-                    "content": fc_content,
-                }
-            )
+        return {
+            "role": "tool",
+            "tool_call_id": tool_call["id"],
+            "content": fc_content,
+        }
+
+    async def __call__(self, msg: list, fc_response: dict) -> dict:
+        fc_message: dict = fc_response["choices"][0]["message"]
+        tool_calls: list[dict] = fc_message["tool_calls"]
+
+        # 同一次回复中的所有函数调用并发执行，结果一并返回后只再请求一次；
+        # 任一调用失败时取消其余调用
+        tasks = [asyncio.ensure_future(self.__exec(call)) for call in tool_calls]
+        try:
+            tool_messages = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+        msg.append(
+            {
+                "role": "assistant",
+                "content": fc_message.get("content"),
+                "tool_calls": tool_calls,
+            }
+        )
+        msg.extend(tool_messages)
 
         plugin_response = await self.gpt(msg)
-        plugin_response["plugin_group"] = fc_plugin_group
+        plugin_response["plugin_group"] = self.fc_map[
+            tool_calls[0]["function"]["name"]
+        ].group_id
         return plugin_response
 
 
@@ -139,12 +434,17 @@ class FunctionRespHandler(RespHandler):
         self, model: str, fc_map: dict, gpt: Callable[[list], Awaitable[dict]]
     ):
         self.adapter = FunctionCallAdapter(model, fc_map, gpt)
+        self.rounds = 0
         return super().__init__(model)
 
     async def handle(self, msg: list, response: dict) -> Message:
         finish_reason = self.extract_finish_reason(response)
 
         if finish_reason == "function_call" or finish_reason == "tool_calls":
+            self.rounds += 1
+            if self.rounds > FC_MAX_ROUNDS:
+                raise ChatError("插件调用次数过多，请简化问题后重试")
+
             fc_gpt_usage = self.extract_usage(response)
             plugin_resp = await self.adapter(msg, response)
             message = await self.handle(msg, plugin_resp)
@@ -173,13 +473,42 @@ class AbstractGPTConnection(ABC):
         temperature=0.5,
         max_tokens=1000,
         selected_plugins: list[FCSpec] = [],
+        on_delta: Optional[DeltaCallback] = None,
     ) -> Message:
         raise NotImplementedError()
 
 
 class MockGPTConnection(AbstractGPTConnection):
-    def __init__(self, model: str, mode: str = "oneshot"):
+    def __init__(
+        self,
+        model: str,
+        mode: str = "oneshot",
+        profile: MockProfile = MOCK_PROFILES[OPENAI_MOCK_PROFILE],
+    ):
         self.model = model
+        self.profile = profile
+
+    async def __complete(
+        self,
+        msg: list,
+        temperature: float,
+        max_tokens: int,
+        tools: list[dict],
+        on_delta: Optional[DeltaCallback],
+    ) -> dict:
+        plan = plan_completion(self.profile, msg, max_tokens, tools)
+        await asyncio.sleep(plan.ttft)
+
+        if plan.error == 429:
+            raise ChatError("API受限，请稍作等待后重试，若一直受限请联系管理员")
+        if plan.error is not None:
+            raise ChatError("API或网络错误，请稍作等待后重试")
+
+        for chunk in plan.chunks:
+            await asyncio.sleep(plan.chunk_delay)
+            if on_delta is not None:
+                await on_delta(chunk)
+        return plan.to_response(self.model)
 
     async def interact(
         self,
@@ -187,54 +516,37 @@ class MockGPTConnection(AbstractGPTConnection):
         temperature=0.5,
         max_tokens=1000,
         selected_plugins: list[FCSpec] = [],
+        on_delta: Optional[DeltaCallback] = None,
     ) -> Message:
-        return Message(
-            sender=0,
-            flag_qcmd=False,
-            content=LIPSUM,
-            interrupted=0,
-            plugin_group="",
-            use_model=self.model,
+        """
+        按 OPENAI_MOCK_PROFILE 模拟上游：首token延迟、流式输出、函数调用、
+        length截断与429/5xx错误，回复经过与 GPTConnection 相同的处理链
+        """
+        tools = [
+            {"type": "function", "function": asdict(fc_spec.definition)}
+            for fc_spec in selected_plugins
+        ]
+        fc_map = {fc_spec.definition.name: fc_spec for fc_spec in selected_plugins}
+        gpt = functools.partial(
+            self.__complete,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            tools=tools,
+            on_delta=on_delta,
+        )
+
+        handler = FunctionRespHandler(self.model, fc_map, gpt)
+        handler.set_next(StopRespHandler(self.model)).set_next(
+            LengthRespHandler(self.model)
         )
+        return await handler.handle(msg, await gpt(msg))
 
 
 class GPTConnection(AbstractGPTConnection):
     def __init__(self, model_engine: str = "Idealab GPT4o", mode: str = "oneshot"):
         self.displayed_model = model_engine
         self.__model_kwargs = {}
-        self.__model_called = CHAT_MODELS[model_engine].model_called
-        self.__setup_gpt_environment = getattr(
-            self, "_setup_" + CHAT_MODELS[model_engine].provider
-        )
-        # self.client = openai.AsyncClient()
-
-    def _setup_azure(self):
-        openai.api_type = "azure"
-        openai.organization = None
-        openai.api_key = AZURE_OPENAI_KEY
-        openai.api_base = AZURE_OPENAI_ENDPOINT
-        openai.api_version = "2023-07-01-preview"
-        self.__model_kwargs["engine"] = self.__model_called
-
-    def _setup_openai(self):
-        openai.api_type = "open_ai"
-        openai.organization = OPENAI_ORGANIZATION
-        openai.api_key = OPENAI_KEY
-        openai.api_base = "https://api.openai.com/v1"
-        openai.api_version = None
-        self.__model_kwargs["model"] = self.__model_called
-
-    def _setup_idealab(self):
-        openai.api_type = "openai"
-        openai.organization = None
-        openai.api_key = IDEALAB_KEY
-        openai.base_url = IDEALAB_ENDPOINT
-        openai.api_version = None
-        # openai.default_headers = {
-        #     'Authorization': f'Bearer {IDEALAB_KEY}',
-        #     'Cookie': os.environ.get("IDEALAB_COOKIE", None)
-        # }
-        self.__model_kwargs["model"] = self.__model_called
+        self.__backends = CHAT_MODELS[model_engine].backends()
 
     def __setup_plugins(self, selected_plugins: list[FCSpec]):
         if selected_plugins:
@@ -244,9 +556,14 @@ class GPTConnection(AbstractGPTConnection):
             ]
         self.fc_map = {fc_spec.definition.name: fc_spec for fc_spec in selected_plugins}
 
-    def __setup_gpt(self, temperature: float, max_tokens: int):
+    def __setup_gpt(
+        self, temperature: float, max_tokens: int, on_delta: Optional[DeltaCallback]
+    ):
         self.gpt = functools.partial(
-            self.__interact_with_gpt, temperature=temperature, max_tokens=max_tokens
+            self.__interact_with_gpt,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            on_delta=on_delta,
         )
 
     def __setup_handlers(self):
@@ -258,11 +575,14 @@ class GPTConnection(AbstractGPTConnection):
         )
 
     def __pre_interact(
-        self, temperature: float, max_tokens: int, selected_plugins: list[FCSpec]
+        self,
+        temperature: float,
+        max_tokens: int,
+        selected_plugins: list[FCSpec],
+        on_delta: Optional[DeltaCallback],
     ):
-        self.__setup_gpt_environment()
         self.__setup_plugins(selected_plugins)
-        self.__setup_gpt(temperature, max_tokens)
+        self.__setup_gpt(temperature, max_tokens, on_delta)
         self.__setup_handlers()
 
     async def __post_interact(self, msg: list, response: dict) -> Message:
@@ -273,6 +593,9 @@ class GPTConnection(AbstractGPTConnection):
         wait=tenacity.wait_random_exponential(min=1, max=5),
         retry=tenacity.retry_if_exception_type(openai.OpenAIError),
         before=tenacity.before_log(logger, logging.DEBUG),
+        before_sleep=lambda retry_state: UPSTREAM_RETRIES.inc(
+            model=retry_state.args[0].displayed_model
+        ),
         reraise=True,
     )
     async def __interact_with_gpt(
@@ -280,16 +603,34 @@ class GPTConnection(AbstractGPTConnection):
         msg: list,
         temperature: float,
         max_tokens: int,
+        on_delta: Optional[DeltaCallback] = None,
     ):
+        backends = backend_router.rank(
+            self.__backends,
+            available=lambda backend: provider_guards.get(backend.provider).available(),
+        )
         try:
-            response = openai.chat.completions.create(
-                messages=msg,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                **self.__model_kwargs,
-            ).to_dict()
-            assert isinstance(response, dict)
-            return response
+            for index, backend in enumerate(backends):
+                start = time.monotonic()
+                try:
+                    response = await self.__interact_with_backend(
+                        backend, msg, temperature, max_tokens, on_delta
+                    )
+                    backend_router.record(backend, time.monotonic() - start, True)
+                    return response
+                except (openai.OpenAIError, ChatError) as e:
+                    if not is_failover_error(e):
+                        raise
+                    backend_router.record(backend, time.monotonic() - start, False)
+                    if index == len(backends) - 1:
+                        raise
+                    backend_router.failovers += 1
+                    logger.warning(
+                        "Backend {0}/{1} failed, failing over: {2}".format(
+                            backend.provider, backend.model_called, e
+                        )
+                    )
+
         except openai.BadRequestError as e:
             logger.error(e)
             raise ChatError("请求失败，输入可能过长，请前往“偏好设置”减少“附带历史消息数”或缩短输入")
@@ -301,16 +642,128 @@ class GPTConnection(AbstractGPTConnection):
         except openai.OpenAIError as _:
             raise
 
+        except ChatError:
+            raise
+
         except Exception as e:
             logger.error(e)
             raise ChatError("服务器遇到未知错误")
 
+    async def __interact_with_backend(
+        self,
+        backend: ModelBackend,
+        msg: list,
+        temperature: float,
+        max_tokens: int,
+        on_delta: Optional[DeltaCallback],
+    ) -> dict:
+        labels = {"model": self.displayed_model, "provider": backend.provider}
+        try:
+            with UPSTREAM_SECONDS.time(**labels):
+                client = provider_registry.get(backend.provider)
+                guard = provider_guards.get(backend.provider)
+                with guard.slot() as call:
+                    try:
+                        response = await self.__request_gpt(
+                            client, backend, msg, temperature, max_tokens, on_delta
+                        )
+                        call.outcome = guard.SUCCESS
+                        return response
+                    except openai.OpenAIError as e:
+                        call.outcome, call.retry_after = classify_openai_error(e)
+                        raise
+                    except ChatError as e:
+                        if isinstance(e.__cause__, openai.OpenAIError):
+                            call.outcome, call.retry_after = classify_openai_error(
+                                e.__cause__
+                            )
+                        raise
+        except Exception as e:
+            UPSTREAM_ERRORS.inc(**labels, error=error_class(e))
+            raise
+
+    async def __request_gpt(
+        self,
+        client: openai.AsyncOpenAI,
+        backend: ModelBackend,
+        msg: list,
+        temperature: float,
+        max_tokens: int,
+        on_delta: Optional[DeltaCallback],
+    ) -> dict:
+        if on_delta is not None:
+            return await self.__stream_with_gpt(
+                client, backend, msg, temperature, max_tokens, on_delta
+            )
+
+        # Azure的deployment名称同样通过model参数传入
+        completion = await client.chat.completions.create(
+            model=backend.model_called,
+            messages=msg,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            **self.__model_kwargs,
+        )
+        response = completion.to_dict()
+        assert isinstance(response, dict)
+        return response
+
+    async def __stream_with_gpt(
+        self,
+        client: openai.AsyncOpenAI,
+        backend: ModelBackend,
+        msg: list,
+        temperature: float,
+        max_tokens: int,
+        on_delta: DeltaCallback,
+    ) -> dict:
+        stream_kwargs = {}
+        if PROVIDERS[backend.provider].stream_usage:
+            stream_kwargs["stream_options"] = {"include_usage": True}
+
+        start = time.monotonic()
+        stream = await client.chat.completions.create(
+            model=backend.model_called,
+            messages=msg,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True,
+            **stream_kwargs,
+            **self.__model_kwargs,
+        )
+
+        accumulator = StreamAccumulator()
+        relayed = False
+        try:
+            # 出错或被取消（如客户端断开）时关闭响应，归还连接池中的连接
+            async with stream:
+                async for chunk in stream:
+                    delta = accumulator.add(chunk.to_dict())
+                    if delta:
+                        if not relayed:
+                            UPSTREAM_TTFT_SECONDS.observe(
+                                time.monotonic() - start,
+                                model=self.displayed_model,
+                                provider=backend.provider,
+                            )
+                        relayed = True
+                        await on_delta(delta)
+        except openai.OpenAIError as e:
+            # 已经输出过的内容无法撤回，不再重试
+            if relayed:
+                logger.error(e)
+                raise ChatError("API或网络错误，请稍作等待后重试") from e
+            raise
+
+        return accumulator.to_dict()
+
     async def interact(
         self,
         msg: list,
         temperature=0.5,
         max_tokens=1000,
         selected_plugins: list[FCSpec] = [],
+        on_delta: Optional[DeltaCallback] = None,
     ) -> Message:
         """
         使用openai包与openai api进行交互
@@ -318,18 +771,20 @@ class GPTConnection(AbstractGPTConnection):
             msg: 用户输入的消息
             temperature: 生成文本的多样性
             max_tokens: 生成文本的长度
-            **kwargs: 其他参数
+            selected_plugins: 可供调用的插件
+            on_delta: 若提供则以流式请求，并逐段回调增量文本
         Returns:
             response: Message对象
         Error:
             ChatError: 若出错则抛出以及对应的status code
         """
-        self.__pre_interact(temperature, max_tokens, selected_plugins)
+        self.__pre_interact(temperature, max_tokens, selected_plugins, on_delta)
 
         try:
-            response = await self.gpt(msg)
-            # assert isinstance(response, dict)
-            return await self.__post_interact(msg, response)
+            async with INTERACT_SECONDS.time(model=self.displayed_model):
+                response = await self.gpt(msg)
+                # assert isinstance(response, dict)
+                return await self.__post_interact(msg, response)
 
         except openai.RateLimitError as e:
             logger.error(e)
@@ -340,10 +795,107 @@ class GPTConnection(AbstractGPTConnection):
             raise ChatError("API或网络错误，请稍作等待后重试")
 
 
+completion_cache = CompletionCache(COMPLETION_CACHE_SIZE, COMPLETION_CACHE_TTL)
+
+
+class CachedGPTConnection(AbstractGPTConnection):
+    """在连接前增加回复缓存，仅对低temperature的请求生效"""
+
+    def __init__(
+        self,
+        model_engine: str,
+        connection: AbstractGPTConnection,
+        cache: CompletionCache = completion_cache,
+    ):
+        self.model_engine = model_engine
+        self.connection = connection
+        self.cache = cache
+
+    async def interact(
+        self,
+        msg: list,
+        temperature=0.5,
+        max_tokens=1000,
+        selected_plugins: list[FCSpec] = [],
+        on_delta: Optional[DeltaCallback] = None,
+    ) -> Message:
+        if temperature > COMPLETION_CACHE_MAX_TEMPERATURE:
+            return await self.connection.interact(
+                msg, temperature, max_tokens, selected_plugins, on_delta
+            )
+
+        key = request_fingerprint(
+            self.model_engine, msg, temperature, max_tokens, selected_plugins
+        )
+        message = self.cache.get(key)
+        if message is not None:
+            if on_delta is not None:
+                await on_delta(message.content)
+            return message
+
+        message = await self.connection.interact(
+            msg, temperature, max_tokens, selected_plugins, on_delta
+        )
+        # 调用过插件的回复依赖实时数据，不缓存
+        if not message.plugin_group:
+            self.cache.set(key, message)
+        return message
+
+
+inflight_requests = SingleFlight()
+
+
+class CoalescedGPTConnection(AbstractGPTConnection):
+    """相同的进行中请求共享一次上游调用的结果"""
+
+    def __init__(
+        self,
+        model_engine: str,
+        connection: AbstractGPTConnection,
+        singleflight: SingleFlight = inflight_requests,
+    ):
+        self.model_engine = model_engine
+        self.connection = connection
+        self.singleflight = singleflight
+
+    async def interact(
+        self,
+        msg: list,
+        temperature=0.5,
+        max_tokens=1000,
+        selected_plugins: list[FCSpec] = [],
+        on_delta: Optional[DeltaCallback] = None,
+    ) -> Message:
+        key = request_fingerprint(
+            self.model_engine, msg, temperature, max_tokens, selected_plugins
+        )
+        message, shared = await self.singleflight.do(
+            key,
+            functools.partial(
+                self.connection.interact,
+                msg,
+                temperature,
+                max_tokens,
+                selected_plugins,
+                on_delta,
+            ),
+        )
+        if not shared:
+            return message
+
+        # 每个请求需要独立的Message对象保存到各自的会话
+        if on_delta is not None:
+            await on_delta(message.content)
+        return copy_reply(message)
+
+
 class GPTConnectionFactory:
     def __init__(self):
         self.__model_engine: str = "nil"
         self.__mock: bool = False
+        self.__coalesce: bool = False
+        self.__cache: bool = False
+        self.__regen: bool = False
 
     def model_engine(self, model_engine: str = "Idealab GPT4o Mini"):
         self.__model_engine = model_engine
@@ -353,11 +905,33 @@ class GPTConnectionFactory:
         self.__mock = mock
         return self
 
+    def coalesce(self, coalesce: bool):
+        self.__coalesce = coalesce
+        return self
+
+    def cache(self, cache: bool):
+        self.__cache = cache
+        return self
+
+    def regen(self, regen: bool):
+        self.__regen = regen
+        return self
+
     def build(self) -> AbstractGPTConnection:
+        connection: AbstractGPTConnection
         if self.__mock:
-            return MockGPTConnection(self.__model_engine)
+            connection = MockGPTConnection(self.__model_engine)
         else:
-            return GPTConnection(self.__model_engine)
+            connection = GPTConnection(self.__model_engine)
+
+        # 重新生成的输入与原请求相同，必须重新请求上游，不使用缓存也不合并
+        if self.__regen:
+            return connection
+        if self.__coalesce:
+            connection = CoalescedGPTConnection(self.__model_engine, connection)
+        if self.__cache:
+            connection = CachedGPTConnection(self.__model_engine, connection)
+        return connection
 
 
 """
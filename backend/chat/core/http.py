@@ -0,0 +1,81 @@
+from typing import Optional
+import asyncio
+import aiohttp
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SharedClientSession:
+    """进程级共享的aiohttp会话
+
+    复用keep-alive连接，并统一限制连接数与超时。会话在首次使用时创建，
+    与创建它的事件循环绑定，事件循环变化时重新创建并关闭旧会话。
+    """
+
+    def __init__(
+        self,
+        limit: int,
+        limit_per_host: int,
+        keepalive_timeout: float,
+        connect_timeout: float,
+        read_timeout: float,
+        total_timeout: Optional[float] = None,
+    ):
+        self.__limit = limit
+        self.__limit_per_host = limit_per_host
+        self.__keepalive_timeout = keepalive_timeout
+        self.__timeout = aiohttp.ClientTimeout(
+            total=total_timeout, sock_connect=connect_timeout, sock_read=read_timeout
+        )
+        self.__session: Optional[aiohttp.ClientSession] = None
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+        self.__closing: set[asyncio.Task] = set()
+
+    def get(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if self.__session is None or self.__session.closed or loop is not self.__loop:
+            if self.__session is not None and not self.__session.closed:
+                self.__discard(self.__session, self.__loop, loop)
+            self.__session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.__limit,
+                    limit_per_host=self.__limit_per_host,
+                    keepalive_timeout=self.__keepalive_timeout,
+                ),
+                timeout=self.__timeout,
+            )
+            self.__loop = loop
+        return self.__session
+
+    def __discard(
+        self,
+        session: aiohttp.ClientSession,
+        old_loop: Optional[asyncio.AbstractEventLoop],
+        loop: asyncio.AbstractEventLoop,
+    ):
+        """关闭被替换的会话：旧事件循环仍在运行时在其中关闭，否则在当前事件循环中关闭"""
+        if old_loop is not None and old_loop.is_running():
+            asyncio.run_coroutine_threadsafe(self.__aclose_quietly(session), old_loop)
+        else:
+            task = loop.create_task(self.__aclose_quietly(session))
+            self.__closing.add(task)
+            task.add_done_callback(self.__closing.discard)
+
+    @staticmethod
+    async def __aclose_quietly(session: aiohttp.ClientSession):
+        try:
+            await session.close()
+        except Exception as e:
+            logger.debug("Failed to close replaced client session: {0}".format(e))
+
+    async def open(self):
+        self.get()
+
+    async def aclose(self):
+        if self.__closing:
+            await asyncio.gather(*self.__closing, return_exceptions=True)
+        if self.__session is not None and not self.__session.closed:
+            await self.__session.close()
+        self.__session = None
+        self.__loop = None
@@ -0,0 +1,271 @@
+# 进程内的指标收集，以Prometheus文本格式（0.0.4）导出
+from typing import Iterable, Optional
+import asyncio
+import functools
+import threading
+import time
+
+# 秒，覆盖数据库查询到完整的模型回复
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], **extra) -> str:
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(k, _escape(v)) for k, v in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        # 指标会在 sync_to_async 的线程中更新
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                "{0} expects labels {1}, got {2}".format(
+                    self.name, self.labelnames, tuple(labels)
+                )
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError()
+
+    def collect(self) -> list[str]:
+        with self._lock:
+            samples = self._samples()
+        return [
+            "# HELP {0} {1}".format(self.name, self.documentation),
+            "# TYPE {0} {1}".format(self.name, self.type),
+            *samples,
+        ]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.__values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.__values[key] = self.__values.get(key, 0) + amount
+
+    def _samples(self) -> list[str]:
+        return [
+            "{0}{1} {2}".format(
+                self.name, _format_labels(self.labelnames, key), _format_value(value)
+            )
+            for key, value in self.__values.items()
+        ]
+
+
+class Timer:
+    """计时并记录到直方图，可作为（同步/异步）上下文管理器或装饰器使用
+
+    若直方图带有 outcome 标签且未手动设置，则按是否抛出异常记为 ok/error
+    """
+
+    def __init__(self, histogram: "Histogram", labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+        self.__start = 0.0
+
+    def __enter__(self) -> "Timer":
+        self.__start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        labels = dict(self.labels)
+        if "outcome" in self.histogram.labelnames and "outcome" not in labels:
+            labels["outcome"] = "ok" if exc_type is None else "error"
+        self.histogram.observe(time.monotonic() - self.__start, **labels)
+
+    async def __aenter__(self) -> "Timer":
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.__exit__(exc_type, exc, tb)
+
+    def __call__(self, func):
+        histogram, labels = self.histogram, self.labels
+
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with Timer(histogram, dict(labels)):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Timer(histogram, dict(labels)):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # 每组标签：各桶计数（非累计）、总和、总数
+        self.__values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self.__values.setdefault(
+                key, ([0] * len(self.buckets), [0.0])
+            )
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            total[0] += value
+
+    def time(self, **labels) -> Timer:
+        return Timer(self, labels)
+
+    def _samples(self) -> list[str]:
+        lines = []
+        for key, (counts, total) in self.__values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(
+                    "{0}_bucket{1} {2}".format(
+                        self.name,
+                        _format_labels(self.labelnames, key, le=_format_value(bound)),
+                        cumulative,
+                    )
+                )
+            labels = _format_labels(self.labelnames, key)
+            lines.append("{0}_sum{1} {2}".format(self.name, labels, repr(total[0])))
+            lines.append("{0}_count{1} {2}".format(self.name, labels, cumulative))
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.__metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.__metrics:
+            raise ValueError("Duplicated metric {0}".format(metric.name))
+        self.__metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        metric = Counter(name, documentation, tuple(labelnames))
+        self.register(metric)
+        return metric
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames=(),
+        buckets: Optional[tuple[float, ...]] = None,
+    ) -> Histogram:
+        metric = Histogram(
+            name, documentation, tuple(labelnames), buckets or DEFAULT_BUCKETS
+        )
+        self.register(metric)
+        return metric
+
+    def expose(self) -> str:
+        lines = []
+        for metric in self.__metrics.values():
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+# 消息处理与模型调用
+HANDLE_MESSAGE_SECONDS = registry.histogram(
+    "chat_handle_message_seconds",
+    "Time spent in handle_message.",
+    ("model", "outcome"),
+)
+INTERACT_SECONDS = registry.histogram(
+    "chat_interact_seconds",
+    "Time spent in GPTConnection.interact, including tool calls and failover.",
+    ("model", "outcome"),
+)
+UPSTREAM_SECONDS = registry.histogram(
+    "chat_upstream_request_seconds",
+    "Latency of a single upstream completion request.",
+    ("model", "provider", "outcome"),
+)
+UPSTREAM_TTFT_SECONDS = registry.histogram(
+    "chat_upstream_ttft_seconds",
+    "Time to first streamed token from the upstream.",
+    ("model", "provider"),
+)
+UPSTREAM_ERRORS = registry.counter(
+    "chat_upstream_errors_total",
+    "Failed upstream completion requests by error class.",
+    ("model", "provider", "error"),
+)
+UPSTREAM_RETRIES = registry.counter(
+    "chat_upstream_retries_total",
+    "Retries of a whole upstream interaction.",
+    ("model",),
+)
+TOKENS = registry.counter(
+    "chat_tokens_total",
+    "Tokens reported by the upstream.",
+    ("model", "kind"),
+)
+
+# 插件
+FC_SECONDS = registry.histogram(
+    "chat_fc_seconds",
+    "Latency of function-call plugin endpoints.",
+    ("function", "outcome"),
+)
+QCMD_SECONDS = registry.histogram(
+    "chat_qcmd_seconds",
+    "Latency of quick command plugins.",
+    ("command", "outcome"),
+)
+
+# 数据库
+DB_SECONDS = registry.histogram(
+    "chat_db_seconds",
+    "Time spent in chat database helpers.",
+    ("operation", "outcome"),
+)
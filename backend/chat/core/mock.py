@@ -0,0 +1,243 @@
+# 模拟上游的回复行为，供 MockGPTConnection 与本地OpenAI兼容模拟服务（manage.py mockgpt）共用
+from .testdata.lipsum import LIPSUM
+from .tokens import REPLY_PRIMING, estimate_content_tokens
+
+from aiohttp import web
+from dataclasses import dataclass, field
+from typing import Optional
+import asyncio
+import random
+import json
+import math
+import time
+import uuid
+
+
+@dataclass(frozen=True)
+class MockProfile:
+    # 首token延迟（秒）：对数正态分布的中位数与sigma
+    ttft: tuple[float, float] = (0.0, 0.0)
+    # 生成速度（token/秒），0表示瞬间完成
+    tokens_per_second: float = 0.0
+    # 回复长度范围（token），(0, 0)表示固定返回LIPSUM
+    completion_tokens: tuple[int, int] = (0, 0)
+    # 流式输出时每个chunk包含的token数
+    chunk_tokens: int = 4
+    # 提供工具时返回函数调用的概率
+    tool_call_rate: float = 0.0
+    # 因max_tokens截断（finish_reason=length）的概率
+    length_rate: float = 0.0
+    # 注入429与5xx错误的概率
+    rate_limit_rate: float = 0.0
+    server_error_rate: float = 0.0
+    # 429时返回的Retry-After（秒）
+    retry_after: float = 1.0
+
+
+MOCK_PROFILES = {
+    # 与旧版一致：立即返回LIPSUM
+    "instant": MockProfile(),
+    # 接近正常线上表现
+    "realistic": MockProfile(
+        ttft=(0.6, 0.5),
+        tokens_per_second=60,
+        completion_tokens=(80, 600),
+        tool_call_rate=0.3,
+        length_rate=0.03,
+        rate_limit_rate=0.01,
+        server_error_rate=0.005,
+    ),
+    # 上游变慢并开始限流
+    "degraded": MockProfile(
+        ttft=(3.0, 0.8),
+        tokens_per_second=15,
+        completion_tokens=(80, 600),
+        tool_call_rate=0.3,
+        length_rate=0.03,
+        rate_limit_rate=0.1,
+        server_error_rate=0.05,
+        retry_after=5,
+    ),
+}
+
+
+@dataclass
+class MockCompletion:
+    """一次模拟回复的完整计划"""
+
+    error: Optional[int] = None
+    ttft: float = 0.0
+    chunks: list[str] = field(default_factory=list)
+    chunk_delay: float = 0.0
+    finish_reason: str = "stop"
+    tool_calls: list[dict] = field(default_factory=list)
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+    def usage(self) -> dict:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.prompt_tokens + self.completion_tokens,
+        }
+
+    def to_response(self, model: str) -> dict:
+        message: dict = {"role": "assistant", "content": "".join(self.chunks)}
+        if self.tool_calls:
+            message["tool_calls"] = self.tool_calls
+        return {
+            "id": "chatcmpl-mock-" + uuid.uuid4().hex,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [
+                {"index": 0, "finish_reason": self.finish_reason, "message": message}
+            ],
+            "usage": self.usage(),
+        }
+
+    def to_chunks(self, model: str, include_usage: bool) -> list[dict]:
+        base = {
+            "id": "chatcmpl-mock-" + uuid.uuid4().hex,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+        }
+
+        def chunk(delta: dict, finish_reason: Optional[str] = None) -> dict:
+            return {
+                **base,
+                "choices": [
+                    {"index": 0, "delta": delta, "finish_reason": finish_reason}
+                ],
+            }
+
+        chunks = [chunk({"role": "assistant", "content": ""})]
+        chunks.extend(chunk({"content": content}) for content in self.chunks)
+        if self.tool_calls:
+            chunks.append(
+                chunk(
+                    {
+                        "tool_calls": [
+                            {"index": index, **tool_call}
+                            for index, tool_call in enumerate(self.tool_calls)
+                        ]
+                    }
+                )
+            )
+        chunks.append(chunk({}, self.finish_reason))
+        if include_usage:
+            chunks.append({**base, "choices": [], "usage": self.usage()})
+        return chunks
+
+
+def lipsum_text(tokens: int) -> str:
+    """按约每4字符1个token截取（循环）LIPSUM"""
+    text = LIPSUM.strip()
+    length = tokens * 4
+    return (text * (length // len(text) + 1))[:length]
+
+
+def plan_completion(
+    profile: MockProfile,
+    msg: list,
+    max_tokens: int,
+    tools: list[dict],
+    rng: Optional[random.Random] = None,
+) -> MockCompletion:
+    rng = rng or random.Random()
+    plan = MockCompletion()
+    plan.prompt_tokens = REPLY_PRIMING + sum(
+        estimate_content_tokens(message.get("content") or "") for message in msg
+    )
+
+    median, sigma = profile.ttft
+    if median > 0:
+        plan.ttft = rng.lognormvariate(math.log(median), sigma)
+
+    roll = rng.random()
+    if roll < profile.rate_limit_rate:
+        plan.error = 429
+        return plan
+    if roll < profile.rate_limit_rate + profile.server_error_rate:
+        plan.error = rng.choice((500, 502, 503))
+        return plan
+
+    # 工具结果之后直接作答，避免模拟出循环调用
+    answered_tool = bool(msg) and msg[-1].get("role") == "tool"
+    if tools and not answered_tool and rng.random() < profile.tool_call_rate:
+        plan.finish_reason = "tool_calls"
+        plan.tool_calls = [
+            {
+                "id": "call_" + uuid.uuid4().hex[:24],
+                "type": "function",
+                "function": {
+                    "name": rng.choice(tools)["function"]["name"],
+                    "arguments": "{}",
+                },
+            }
+        ]
+        plan.completion_tokens = 12
+        return plan
+
+    low, high = profile.completion_tokens
+    if high == 0:
+        content = LIPSUM
+        plan.completion_tokens = math.ceil(len(content) / 4)
+    else:
+        plan.completion_tokens = rng.randint(low, high)
+        if plan.completion_tokens >= max_tokens or rng.random() < profile.length_rate:
+            plan.completion_tokens = min(plan.completion_tokens, max_tokens)
+            plan.finish_reason = "length"
+        content = lipsum_text(plan.completion_tokens)
+
+    step = profile.chunk_tokens * 4
+    plan.chunks = [content[i : i + step] for i in range(0, len(content), step)]
+    if profile.tokens_per_second > 0:
+        plan.chunk_delay = profile.chunk_tokens / profile.tokens_per_second
+    return plan
+
+
+def build_stub_app(profile: MockProfile) -> web.Application:
+    """按profile模拟 /v1/chat/completions 的OpenAI兼容服务"""
+
+    async def chat_completions(request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        model = body.get("model", "mock")
+        plan = plan_completion(
+            profile,
+            body.get("messages", []),
+            body.get("max_tokens") or 1000,
+            body.get("tools") or [],
+        )
+        await asyncio.sleep(plan.ttft)
+
+        if plan.error is not None:
+            headers = {}
+            if plan.error == 429:
+                headers["Retry-After"] = str(profile.retry_after)
+            return web.json_response(
+                {"error": {"message": "mock error", "type": "mock", "code": None}},
+                status=plan.error,
+                headers=headers,
+            )
+
+        if not body.get("stream"):
+            await asyncio.sleep(plan.chunk_delay * len(plan.chunks))
+            return web.json_response(plan.to_response(model))
+
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for chunk in plan.to_chunks(model, include_usage):
+            if chunk["choices"] and chunk["choices"][0]["delta"].get("content"):
+                await asyncio.sleep(plan.chunk_delay)
+            await response.write("data: {0}\n\n".format(json.dumps(chunk)).encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_post("/chat/completions", chat_completions)
+    return app
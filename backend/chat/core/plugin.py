@@ -1,22 +1,27 @@
 import tenacity
-from .configs import FC_API_ENDPOINT
+from .configs import FC_API_ENDPOINT, QCMD_TIMEOUT
+from .metrics import QCMD_SECONDS
 from .plugins import qcmd, fc
 
 from dataclasses import dataclass
 from dacite import from_dict
 import logging
 import requests
+import asyncio
 import json
 
 
 logger = logging.getLogger(__name__)
 
-# 支持快捷命令的插件列表
-qcmd_plugins_list: list[qcmd.BasePlugin] = [
-    qcmd.SjmcPlugin(),
-    qcmd.CanteenPlugin(),
-    qcmd.LibraryPlugin(),
-    qcmd.SummerInfoPlugin(),
+# 支持快捷命令的插件列表，旧式同步插件（qcmd.BasePlugin）会被包装后在线程池中执行
+qcmd_plugins_list: list[qcmd.AsyncBasePlugin] = [
+    qcmd.as_async_plugin(plugin)
+    for plugin in [
+        qcmd.SjmcPlugin(),
+        qcmd.CanteenPlugin(),
+        qcmd.LibraryPlugin(),
+        qcmd.SummerInfoPlugin(),
+    ]
 ]
 
 
@@ -69,7 +74,13 @@ plugins_list_serialized: bytes = json.dumps(
 ).encode()
 
 
-def check_and_exec_qcmds(msg: str) -> PluginResponse:
+def __qcmd_name(plugin: qcmd.AsyncBasePlugin) -> str:
+    if isinstance(plugin, qcmd.SyncPluginAdapter):
+        plugin = plugin.plugin
+    return type(plugin).__name__
+
+
+async def check_and_exec_qcmds(msg: str) -> PluginResponse:
     """快捷命令匹配插件、执行并得到结果
 
     Args:
@@ -82,6 +93,18 @@ def check_and_exec_qcmds(msg: str) -> PluginResponse:
     """
     for plugin in qcmd_plugins_list:
         if plugin.qcmd_trigger(msg):
-            success, response = plugin.qcmd_response(msg)
+            with QCMD_SECONDS.time(command=__qcmd_name(plugin)) as timer:
+                try:
+                    success, response = await asyncio.wait_for(
+                        plugin.qcmd_response(msg), QCMD_TIMEOUT
+                    )
+                except asyncio.TimeoutError:
+                    # 同步插件的线程无法取消，但不再等待其结果
+                    logger.warning("Quick command {0} timed out".format(msg))
+                    success, response = False, "快捷命令响应超时"
+                    timer.labels["outcome"] = "timeout"
+                else:
+                    if not success:
+                        timer.labels["outcome"] = "failed"
             return PluginResponse(triggered=True, success=success, content=response)
     return PluginResponse(triggered=False, success=False, content="无指令匹配")
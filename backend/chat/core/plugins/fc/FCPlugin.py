@@ -1,8 +1,25 @@
-from ...configs import FC_API_ENDPOINT
+from ...configs import (
+    FC_API_ENDPOINT,
+    FC_POOL_LIMIT,
+    FC_POOL_LIMIT_PER_HOST,
+    FC_KEEPALIVE_TIMEOUT,
+    FC_CONNECT_TIMEOUT,
+    FC_READ_TIMEOUT,
+)
+from ...http import SharedClientSession
+from ...metrics import FC_SECONDS
 
 from typing import Callable, Awaitable, Union
 from dataclasses import dataclass
-import aiohttp
+
+# 所有插件端点共用的连接池
+fc_session = SharedClientSession(
+    limit=FC_POOL_LIMIT,
+    limit_per_host=FC_POOL_LIMIT_PER_HOST,
+    keepalive_timeout=FC_KEEPALIVE_TIMEOUT,
+    connect_timeout=FC_CONNECT_TIMEOUT,
+    read_timeout=FC_READ_TIMEOUT,
+)
 
 
 @dataclass
@@ -74,14 +91,15 @@ class FCEndpoint:
 
     async def fc_response(self, msg: str) -> tuple[bool, str]:
         assert FC_API_ENDPOINT is not None
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
+        with FC_SECONDS.time(function=self.fc_id) as timer:
+            async with fc_session.get().post(
                 url=FC_API_ENDPOINT + "/" + self.route,
                 headers={"content-type": "application/json"},
                 data=msg,
             ) as resp:
                 r = FCResponse(**(await resp.json()))
-                if r.code == 0:
-                    return True, r.data
-                else:
-                    return False, r.message
+            if r.code == 0:
+                return True, r.data
+            else:
+                timer.labels["outcome"] = "failed"
+                return False, r.message
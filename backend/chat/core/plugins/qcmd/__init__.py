@@ -2,4 +2,11 @@ from .canteenPlugin import *
 from .libraryPlugin import *
 from .sjmcPlugin import *
 from .summerInfoPlugin import *
-from .basePlugin import BasePlugin
+from .basePlugin import (
+    BasePlugin,
+    AsyncBasePlugin,
+    SyncPluginAdapter,
+    as_async_plugin,
+    qcmd_session,
+)
+from .staleCache import StaleWhileRevalidateCache, CachedData, qcmd_cache
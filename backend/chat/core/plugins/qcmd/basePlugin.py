@@ -1,9 +1,37 @@
 # 插件基类定义
+from ...configs import (
+    QCMD_POOL_LIMIT,
+    QCMD_CONNECT_TIMEOUT,
+    QCMD_READ_TIMEOUT,
+    QCMD_TIMEOUT,
+    QCMD_SYNC_WORKERS,
+)
+from ...http import SharedClientSession
+
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+import asyncio
+
+# 快捷命令访问校园接口共用的连接池
+qcmd_session = SharedClientSession(
+    limit=QCMD_POOL_LIMIT,
+    limit_per_host=QCMD_POOL_LIMIT,
+    keepalive_timeout=30,
+    connect_timeout=QCMD_CONNECT_TIMEOUT,
+    read_timeout=QCMD_READ_TIMEOUT,
+    total_timeout=QCMD_TIMEOUT,
+)
+
+# 旧式同步插件在独立的线程池中运行，不占用事件循环
+qcmd_executor = ThreadPoolExecutor(
+    max_workers=QCMD_SYNC_WORKERS, thread_name_prefix="qcmd"
+)
 
 
 class BasePlugin(ABC):
+    """旧式同步插件，qcmd_response 会阻塞，由 SyncPluginAdapter 放入线程池执行"""
+
     @abstractmethod
     def qcmd_description(self) -> dict[str, str]:
         raise NotImplementedError
@@ -32,3 +60,46 @@ class BasePlugin(ABC):
             response(str): 回复的信息
         """
         raise NotImplementedError
+
+
+class AsyncBasePlugin(ABC):
+    """异步插件，网络请求应使用 qcmd_session"""
+
+    @abstractmethod
+    def qcmd_description(self) -> dict[str, str]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def qcmd_trigger(self, msg: str) -> bool:
+        """判断快捷命令是否能够触发（不应有IO）"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def qcmd_response(self, msg: str) -> tuple[bool, str]:
+        """快捷命令的回复，返回值同 BasePlugin.qcmd_response"""
+        raise NotImplementedError
+
+
+class SyncPluginAdapter(AsyncBasePlugin):
+    """将旧式同步插件包装为异步插件"""
+
+    def __init__(self, plugin: BasePlugin):
+        self.plugin = plugin
+
+    def qcmd_description(self) -> dict[str, str]:
+        return self.plugin.qcmd_description()
+
+    def qcmd_trigger(self, msg: str) -> bool:
+        return self.plugin.qcmd_trigger(msg)
+
+    async def qcmd_response(self, msg: str) -> tuple[bool, str]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            qcmd_executor, self.plugin.qcmd_response, msg
+        )
+
+
+def as_async_plugin(plugin) -> AsyncBasePlugin:
+    if isinstance(plugin, AsyncBasePlugin):
+        return plugin
+    return SyncPluginAdapter(plugin)
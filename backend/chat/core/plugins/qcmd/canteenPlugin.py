@@ -1,8 +1,8 @@
-from .basePlugin import BasePlugin
-import requests
+from .basePlugin import AsyncBasePlugin, qcmd_session
+from .staleCache import qcmd_cache
 
 
-class CanteenPlugin(BasePlugin):
+class CanteenPlugin(AsyncBasePlugin):
     """
     获取就餐指数插件
     """
@@ -13,10 +13,11 @@ class CanteenPlugin(BasePlugin):
     def qcmd_trigger(self, msg: str) -> bool:
         return msg == "/jczs"
 
-    def qcmd_response(self, msg: str):
-        canteen_list = get_canteen_list()
-        if canteen_list is None:
+    async def qcmd_response(self, msg: str):
+        cached = await qcmd_cache.get("canteen", get_canteen_list)
+        if cached is None:
             return False, "快捷命令出现错误"
+        canteen_list = cached.data
         if len(canteen_list) == 0:
             return True, "就餐指数API失效或当前校内食堂均未开放~"
         resp_str = "当前校内食堂就餐指数（就餐人数/总座位数）如下："
@@ -28,19 +29,19 @@ class CanteenPlugin(BasePlugin):
                     canteen.get("Seat_s", ""),
                     (canteen.get("Seat_u", "") / canteen.get("Seat_s", "") * 100),
                 )
-            return True, resp_str
+            return True, resp_str + cached.notice()
         except Exception:
             return False, "快捷命令出现错误"
 
 
-def get_canteen_list():
+async def get_canteen_list():
     url = f"https://canteen.sjtu.edu.cn/CARD/Ajax/Place"
     canteen_list = []
     try:
-        res = requests.get(url=url)
-        if res.status_code != requests.codes.ok:
-            return None
-        canteen_list = res.json()
+        async with qcmd_session.get().get(url) as res:
+            if res.status != 200:
+                return None
+            canteen_list = await res.json(content_type=None)
         return canteen_list
     except Exception as e:
         return None
@@ -1,10 +1,10 @@
-from .basePlugin import BasePlugin
+from .basePlugin import AsyncBasePlugin, qcmd_session
+from .staleCache import qcmd_cache
 
-import requests
 import json
 
 
-class LibraryPlugin(BasePlugin):
+class LibraryPlugin(AsyncBasePlugin):
     """
     获取图书馆信息插件
     """
@@ -15,10 +15,11 @@ class LibraryPlugin(BasePlugin):
     def qcmd_trigger(self, msg: str) -> bool:
         return msg == "/lib"
 
-    def qcmd_response(self, msg: str):
-        library_list = get_library_list()
-        if library_list is None:
+    async def qcmd_response(self, msg: str):
+        cached = await qcmd_cache.get("library", get_library_list)
+        if cached is None:
             return False, "快捷命令出现错误"
+        library_list = cached.data
         if len(library_list) == 0:
             return True, "图书馆API失效或当前校内图书馆均未开放~"
         resp_str = "当前校内图书馆开放指数（在馆人数/总座位数）如下："
@@ -33,20 +34,21 @@ class LibraryPlugin(BasePlugin):
                         library.get("max", ""),
                         (library.get("inCounter", "") / library.get("max", "") * 100),
                     )
-            return True, resp_str
+            return True, resp_str + cached.notice()
         except Exception as e:
             print(e)
             return False, "快捷命令出现错误"
 
 
-def get_library_list():
+async def get_library_list():
     url = f"https://zgrstj.lib.sjtu.edu.cn/cp"
     library_list = []
     try:
-        res = requests.get(url=url)
-        if res.status_code != requests.codes.ok:
-            return None
-        library_list = json.loads(res.text[12:-2])["numbers"]
+        async with qcmd_session.get().get(url) as res:
+            if res.status != 200:
+                return None
+            text = await res.text()
+        library_list = json.loads(text[12:-2])["numbers"]
         return library_list
     except Exception:
         return None
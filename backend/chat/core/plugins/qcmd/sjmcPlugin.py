@@ -1,8 +1,8 @@
-from .basePlugin import BasePlugin
-import requests
+from .basePlugin import AsyncBasePlugin, qcmd_session
+from .staleCache import qcmd_cache
 
 
-class SjmcPlugin(BasePlugin):
+class SjmcPlugin(AsyncBasePlugin):
     """
     获取SJMC服务器信息插件
     """
@@ -13,24 +13,25 @@ class SjmcPlugin(BasePlugin):
     def qcmd_trigger(self, msg: str) -> bool:
         return msg == "/sjmc"
 
-    def qcmd_response(self, msg: str):
-        server_list = get_server_list()
-        if (server_list is None) or (len(server_list) == 0):
+    async def qcmd_response(self, msg: str):
+        cached = await qcmd_cache.get("sjmc", get_server_list)
+        if (cached is None) or (len(cached.data) == 0):
             return False, "快捷命令出现错误"
+        server_list = cached.data
         resp_str = "上海交通大学 Minecraft 社当前的服务器列表如下："
         for server in server_list:
             resp_str += f"\n* **\"{server.get('title','')}\"**，{server.get('ip','')}"
-        return True, resp_str
+        return True, resp_str + cached.notice()
 
 
-def get_server_list():
+async def get_server_list():
     url = f"https://mc.sjtu.cn/custom/serverlist/?list=sjmc"
     server_list = []
     try:
-        res = requests.get(url=url)
-        if res.status_code != requests.codes.ok:
-            return None
-        server_list = res.json()
+        async with qcmd_session.get().get(url) as res:
+            if res.status != 200:
+                return None
+            server_list = await res.json(content_type=None)
         return server_list
     except Exception:
         return None
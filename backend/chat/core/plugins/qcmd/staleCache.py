@@ -0,0 +1,148 @@
+# 校园数据的缓存：过期后先返回旧数据并在后台刷新，上游出错时返回标记为过期的旧数据
+from ...configs import QCMD_CACHE, QCMD_CACHE_TTL, QCMD_CACHE_MAX_STALE, QCMD_TIMEOUT
+from ...singleflight import SingleFlight
+
+from django.core.cache import caches
+from django.utils import timezone
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Optional
+import datetime
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedData:
+    data: Any
+    # 获取数据的时间（time.time()，多进程间可比较）
+    fetched: float
+    # 数据已过期且最近一次刷新失败
+    stale: bool
+
+    def notice(self) -> str:
+        """过期数据附加在回复末尾的说明"""
+        if not self.stale:
+            return ""
+        fetched = timezone.localtime(
+            datetime.datetime.fromtimestamp(self.fetched, tz=datetime.timezone.utc)
+        )
+        return "\n\n> 数据源暂时无法访问，以上为 {0} 的数据".format(
+            fetched.strftime("%H:%M")
+        )
+
+
+class StaleWhileRevalidateCache:
+    """快捷命令的数据缓存
+
+    数据保存在 Django 缓存 qcmd:{name} 中，多进程部署时配置为共享后端即可共用。
+    获取后 ttl 秒内直接返回；过期后仍立即返回旧数据，同时在后台刷新（跨进程
+    通过 add 锁只刷新一次，刷新成功后释放，失败时保留到超时作为重试间隔）；
+    刷新失败时旧数据最多保留 max_stale 秒，并标记为过期。
+
+    fetch 返回 None 表示上游出错，与各插件原有的约定一致。
+    """
+
+    def __init__(
+        self, cache_alias: str, ttl: float, max_stale: float, lock_timeout: float
+    ):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.lock_timeout = lock_timeout
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self.stale_fallbacks = 0
+        self.__cache_alias = cache_alias
+        self.__flight = SingleFlight()
+        self.__tasks: set[asyncio.Task] = set()
+
+    @property
+    def cache(self):
+        return caches[self.__cache_alias]
+
+    @staticmethod
+    def key(name: str) -> str:
+        return "qcmd:{0}".format(name)
+
+    async def get(
+        self, name: str, fetch: Callable[[], Awaitable[Any]]
+    ) -> Optional[CachedData]:
+        """
+        Returns:
+            缓存或新获取的数据，没有可用数据且上游出错时返回None
+        """
+        key = self.key(name)
+        entry = self.cache.get(key)
+
+        if entry is None:
+            self.misses += 1
+            entry, _ = await self.__flight.do(key, lambda: self.__refresh(key, fetch))
+            if entry is None:
+                return None
+            return CachedData(entry["data"], entry["fetched"], stale=False)
+
+        if time.time() - entry["fetched"] < self.ttl:
+            self.hits += 1
+        else:
+            self.stale_hits += 1
+            self.__revalidate(key, fetch)
+        if entry["failed"]:
+            self.stale_fallbacks += 1
+        return CachedData(entry["data"], entry["fetched"], stale=entry["failed"])
+
+    def __revalidate(self, key: str, fetch: Callable[[], Awaitable[Any]]):
+        # 其他进程正在刷新，或上次刷新失败后未到重试时间
+        if not self.cache.add(key + ":lock", 1, timeout=self.lock_timeout):
+            return
+        task = asyncio.create_task(
+            self.__flight.do(key, lambda: self.__refresh(key, fetch))
+        )
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+
+    async def __refresh(
+        self, key: str, fetch: Callable[[], Awaitable[Any]]
+    ) -> Optional[dict]:
+        self.refreshes += 1
+        try:
+            data = await fetch()
+        except Exception as e:
+            logger.warning("Failed to refresh {0}: {1}".format(key, e))
+            data = None
+
+        now = time.time()
+        if data is not None:
+            entry = {"data": data, "fetched": now, "failed": False}
+            self.cache.set(key, entry, timeout=self.max_stale)
+            self.cache.delete(key + ":lock")
+            return entry
+
+        self.refresh_failures += 1
+        entry = self.cache.get(key)
+        if entry is not None and not entry["failed"]:
+            remaining = self.max_stale - (now - entry["fetched"])
+            if remaining > 0:
+                self.cache.set(key, {**entry, "failed": True}, timeout=remaining)
+        return None
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.stale_hits) / lookups if lookups else 0.0,
+            "refreshes": self.refreshes,
+            "refresh_failures": self.refresh_failures,
+            "stale_fallbacks": self.stale_fallbacks,
+        }
+
+
+qcmd_cache = StaleWhileRevalidateCache(
+    QCMD_CACHE, QCMD_CACHE_TTL, QCMD_CACHE_MAX_STALE, QCMD_TIMEOUT
+)
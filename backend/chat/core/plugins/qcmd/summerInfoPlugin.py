@@ -1,4 +1,4 @@
-from .basePlugin import BasePlugin
+from .basePlugin import AsyncBasePlugin
 
 SUMMER_INFO = """<details>
 <summary>暑期生活信息详情</summary>
@@ -304,7 +304,7 @@ SUMMER_INFO = """<details>
 </details>"""
 
 
-class SummerInfoPlugin(BasePlugin):
+class SummerInfoPlugin(AsyncBasePlugin):
     """
     暑期信息插件
     """
@@ -315,5 +315,5 @@ class SummerInfoPlugin(BasePlugin):
     def qcmd_trigger(self, msg: str) -> bool:
         return msg == "/summer"
 
-    def qcmd_response(self, msg: str):
+    async def qcmd_response(self, msg: str):
         return True, SUMMER_INFO
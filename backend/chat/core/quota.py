@@ -0,0 +1,195 @@
+from ..models import UserAccount
+from .errors import ChatError
+from .db import db_writer
+from .configs import STUDENT_LIMIT, QUOTA_CACHE, QUOTA_FLUSH_INTERVAL
+
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+from dataclasses import dataclass
+from typing import Optional
+import datetime
+import asyncio
+import atexit
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 计数在缓存中保留的时间（秒），覆盖跨日与写回延迟
+QUOTA_KEY_TTL = 2 * 24 * 3600
+
+
+@dataclass(frozen=True)
+class QuotaReservation:
+    user_id: int
+    day: datetime.date
+
+
+class QuotaLedger:
+    """学生每日用量的计数器
+
+    计数保存在缓存 quota:{user}:{day} 中，当日首次使用时从 UserAccount 读取
+    一次作为初始值（跨日则从0开始，不写数据库）。检查与占用通过一次原子的
+    incr 完成，超出上限时立即退回；模型调用失败时释放占用。确认的次数记在
+    进程内，由后台任务定期以 F("usage_count") + n 累加写回 UserAccount，
+    未确认的占用不会写入数据库。
+
+    关闭时由 asgi 的 shutdown 钩子（lifespan 或 daphne 的 reactor 关闭事件）调用
+    aclose 写回剩余次数；钩子未执行时（如事件循环已不可用）由 atexit 同步写回。
+
+    多进程部署时缓存必须为共享后端（如Redis），否则各进程分别计数，
+    服务进程加载 ASGI 入口时由 check_deployment 检查。
+    注意 BaseCache.aincr 是非原子的 get+set，这里直接使用后端的同步 incr/decr。
+    """
+
+    def __init__(self, limit: int, cache_alias: str, flush_interval: float):
+        self.limit = limit
+        self.flush_interval = flush_interval
+        self.__cache_alias = cache_alias
+        # 已确认但尚未写回数据库的次数
+        self.__pending: dict[QuotaReservation, int] = {}
+        self.__flusher: Optional[asyncio.Task] = None
+        atexit.register(self.flush_at_exit)
+
+    @property
+    def cache(self):
+        return caches[self.__cache_alias]
+
+    @staticmethod
+    def key(user_id: int, day: datetime.date) -> str:
+        return "quota:{0}:{1}".format(user_id, day.isoformat())
+
+    async def __seed(self, user_id: int, day: datetime.date):
+        key = self.key(user_id, day)
+        if self.cache.get(key) is not None:
+            return
+        account = (
+            await UserAccount.objects.filter(user_id=user_id)
+            .values("usage_count", "last_used")
+            .afirst()
+        )
+        if account is None:
+            raise ChatError("用户信息错误", status=404)
+        used = account["usage_count"] if account["last_used"] == day else 0
+        # 本进程已确认但尚未写回的次数
+        used += self.__pending.get(QuotaReservation(user_id, day), 0)
+        # 并发请求同时初始化时只有一个生效
+        self.cache.add(key, used, timeout=QUOTA_KEY_TTL)
+
+    async def reserve(self, user_id: int) -> Optional[QuotaReservation]:
+        """
+        占用一次当日额度
+        Returns:
+            成功时返回占用记录，已到达上限时返回None
+        """
+        reservation = QuotaReservation(user_id, timezone.localdate())
+        key = self.key(user_id, reservation.day)
+        await self.__seed(user_id, reservation.day)
+        try:
+            used = self.cache.incr(key)
+        except ValueError:
+            # 初始化后被缓存淘汰
+            await self.__seed(user_id, reservation.day)
+            used = self.cache.incr(key)
+
+        if used > self.limit:
+            self.cache.decr(key)
+            return None
+        return reservation
+
+    async def release(self, reservation: QuotaReservation):
+        try:
+            self.cache.decr(self.key(reservation.user_id, reservation.day))
+        except ValueError:
+            pass
+
+    def commit(self, reservation: QuotaReservation):
+        """确认占用，次数稍后写回数据库"""
+        self.__pending[reservation] = self.__pending.get(reservation, 0) + 1
+        loop = asyncio.get_running_loop()
+        if (
+            self.__flusher is None
+            or self.__flusher.done()
+            or self.__flusher.get_loop() is not loop
+        ):
+            self.__flusher = loop.create_task(self.__run())
+
+    def usage(self, user_id: int) -> int:
+        """当日已用次数（同步），缓存中没有计数时才读取 UserAccount"""
+        today = timezone.localdate()
+        used = self.cache.get(self.key(user_id, today))
+        if used is not None:
+            return used
+        account = UserAccount.objects.get(user_id=user_id)
+        return account.usage_count if account.last_used == today else 0
+
+    async def flush(self):
+        pending, self.__pending = self.__pending, {}
+        try:
+            if pending:
+                await db_writer(self.__write)(list(pending.items()))
+        except Exception:
+            for reservation, count in pending.items():
+                self.__pending[reservation] = (
+                    self.__pending.get(reservation, 0) + count
+                )
+            raise
+
+    def flush_at_exit(self):
+        """进程退出时同步写回尚未写回的次数"""
+        pending, self.__pending = self.__pending, {}
+        if not pending:
+            return
+        try:
+            self.__write(list(pending.items()))
+        except Exception as e:
+            logger.error(
+                "Failed to flush quota at exit, {0} uses lost: {1}".format(
+                    sum(pending.values()), e
+                )
+            )
+
+    @staticmethod
+    @transaction.atomic()
+    def __write(rows: list[tuple[QuotaReservation, int]]):
+        for reservation, count in rows:
+            # 同一天累加，跨日则从本次的次数重新开始；较早日期的次数不再写入
+            UserAccount.objects.filter(
+                user_id=reservation.user_id, last_used__lte=reservation.day
+            ).update(
+                usage_count=Case(
+                    When(last_used=reservation.day, then=F("usage_count") + count),
+                    default=Value(count),
+                ),
+                last_used=reservation.day,
+            )
+
+    def check_deployment(self, workers: int):
+        """多进程部署时各进程必须共用计数"""
+        if workers > 1 and isinstance(self.cache, LocMemCache):
+            raise ImproperlyConfigured(
+                "Cache '{0}' is process-local but {1} workers are configured; "
+                "use a shared cache backend for the quota ledger.".format(
+                    self.__cache_alias, workers
+                )
+            )
+
+    async def __run(self):
+        while self.__pending:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Failed to flush quota: {0}".format(e))
+
+    async def aclose(self):
+        if self.__flusher is not None and not self.__flusher.done():
+            self.__flusher.cancel()
+        self.__flusher = None
+        await self.flush()
+
+
+quota_ledger = QuotaLedger(STUDENT_LIMIT, QUOTA_CACHE, QUOTA_FLUSH_INTERVAL)
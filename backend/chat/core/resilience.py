@@ -0,0 +1,230 @@
+from .errors import ChatError
+
+from contextlib import contextmanager
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Optional
+import time
+
+
+class CircuitBreaker:
+    """连续失败达到阈值后断开，冷却后放行单个探测请求，成功则恢复"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, recovery_time: float):
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.__probing = False
+
+    def is_open(self) -> bool:
+        return (
+            self.state == self.OPEN
+            and time.monotonic() - self.opened_at < self.recovery_time
+        )
+
+    def allow(self) -> bool:
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.recovery_time:
+                return False
+            self.state = self.HALF_OPEN
+            self.__probing = False
+
+        if self.state == self.HALF_OPEN:
+            if self.__probing:
+                return False
+            self.__probing = True
+        return True
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.__probing = False
+
+    def record_neutral(self):
+        # 结果无法说明服务是否可用（如请求本身有误），释放探测名额
+        self.__probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+        self.__probing = False
+
+    def stats(self) -> dict:
+        return {"state": self.state, "failures": self.failures}
+
+
+class AdaptiveLimiter:
+    """AIMD并发限制：成功时缓慢增加上限，过载时成倍减小，并遵守Retry-After"""
+
+    def __init__(
+        self,
+        initial: float,
+        min_limit: float,
+        max_limit: float,
+        backoff: float = 0.5,
+    ):
+        self.limit = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.inflight = 0
+        self.blocked_until = 0.0
+
+    def blocked_for(self) -> float:
+        return max(self.blocked_until - time.monotonic(), 0.0)
+
+    def try_acquire(self) -> bool:
+        if self.inflight >= int(self.limit):
+            return False
+        self.inflight += 1
+        return True
+
+    def on_success(self):
+        self.inflight -= 1
+        # 每完成约一个窗口（limit个请求）上限加一
+        self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+
+    def on_overload(self, retry_after: Optional[float] = None):
+        self.inflight -= 1
+        self.limit = max(self.limit * self.backoff, self.min_limit)
+        if retry_after:
+            self.blocked_until = max(
+                self.blocked_until, time.monotonic() + retry_after
+            )
+
+    def on_ignore(self):
+        self.inflight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "limit": int(self.limit),
+            "inflight": self.inflight,
+            "blocked_for": round(self.blocked_for(), 3),
+        }
+
+
+def parse_retry_after(headers) -> Optional[float]:
+    """解析Retry-After（秒数或HTTP日期）及retry-after-ms响应头"""
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return parsedate_to_datetime(value).timestamp() - time.time()
+    except (TypeError, ValueError):
+        return None
+
+
+class ProviderUnavailable(ChatError):
+    """provider暂不可用（未配置、熔断或超出并发限制），可切换到其他等价后端"""
+
+
+@dataclass
+class GuardedCall:
+    """由调用方写入的单次请求结果"""
+
+    outcome: str = "ignore"
+    retry_after: Optional[float] = None
+
+
+class ProviderGuard:
+    """单个provider的熔断器与并发限制"""
+
+    SUCCESS = "success"
+    FAILURE = "failure"
+    OVERLOAD = "overload"
+    IGNORE = "ignore"
+
+    def __init__(self, breaker: CircuitBreaker, limiter: AdaptiveLimiter):
+        self.breaker = breaker
+        self.limiter = limiter
+        self.rejected = 0
+
+    def available(self) -> bool:
+        return not self.breaker.is_open() and self.limiter.blocked_for() == 0
+
+    @contextmanager
+    def slot(self):
+        """占用一个请求名额，超限时立即抛出ChatError
+
+        调用方需在yield的GuardedCall中写入本次请求的结果
+        """
+        if self.limiter.blocked_for() > 0:
+            self.rejected += 1
+            raise ProviderUnavailable(
+                "API受限，请稍作等待后重试，若一直受限请联系管理员", status=429
+            )
+        # 先占用并发名额：breaker.allow 在半开状态下会占用唯一的探测名额
+        if not self.limiter.try_acquire():
+            self.rejected += 1
+            raise ProviderUnavailable("服务繁忙，请稍后重试", status=503)
+        if not self.breaker.allow():
+            self.limiter.on_ignore()
+            self.rejected += 1
+            raise ProviderUnavailable("模型服务暂时不可用，请稍后重试", status=503)
+
+        call = GuardedCall()
+        try:
+            yield call
+        finally:
+            if call.outcome == self.SUCCESS:
+                self.breaker.record_success()
+                self.limiter.on_success()
+            elif call.outcome == self.OVERLOAD:
+                self.breaker.record_failure()
+                self.limiter.on_overload(call.retry_after)
+            elif call.outcome == self.FAILURE:
+                self.breaker.record_failure()
+                self.limiter.on_ignore()
+            else:
+                self.breaker.record_neutral()
+                self.limiter.on_ignore()
+
+    def stats(self) -> dict:
+        return {
+            "breaker": self.breaker.stats(),
+            "limiter": self.limiter.stats(),
+            "rejected": self.rejected,
+        }
+
+
+class ProviderGuards:
+    """按provider索引的ProviderGuard，首次使用时创建"""
+
+    def __init__(
+        self,
+        failure_threshold: int,
+        recovery_time: float,
+        initial_limit: float,
+        min_limit: float,
+        max_limit: float,
+    ):
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.__guards: dict[str, ProviderGuard] = {}
+
+    def get(self, provider: str) -> ProviderGuard:
+        if provider not in self.__guards:
+            self.__guards[provider] = ProviderGuard(
+                CircuitBreaker(self.failure_threshold, self.recovery_time),
+                AdaptiveLimiter(self.initial_limit, self.min_limit, self.max_limit),
+            )
+        return self.__guards[provider]
+
+    def stats(self) -> dict:
+        return {provider: guard.stats() for provider, guard in self.__guards.items()}
@@ -0,0 +1,83 @@
+from .configs import ModelBackend
+
+from collections import deque
+from typing import Callable, Iterable
+import time
+
+
+class BackendStats:
+    """单个后端在滑动窗口内的延迟与错误记录"""
+
+    def __init__(self, window_size: int, window_time: float):
+        self.window_time = window_time
+        self.__samples: deque[tuple[float, float, bool]] = deque(maxlen=window_size)
+
+    def __prune(self):
+        deadline = time.monotonic() - self.window_time
+        while self.__samples and self.__samples[0][0] < deadline:
+            self.__samples.popleft()
+
+    def record(self, latency: float, ok: bool):
+        self.__samples.append((time.monotonic(), latency, ok))
+
+    def score(self, error_penalty: float) -> float:
+        """越小越优先；窗口内没有记录的后端得分为0，会被优先尝试"""
+        self.__prune()
+        if not self.__samples:
+            return 0.0
+        latencies = [latency for _, latency, ok in self.__samples if ok]
+        error_rate = 1 - len(latencies) / len(self.__samples)
+        mean_latency = sum(latencies) / len(latencies) if latencies else 0.0
+        return mean_latency + error_rate * error_penalty
+
+    def stats(self) -> dict:
+        self.__prune()
+        total = len(self.__samples)
+        latencies = sorted(latency for _, latency, ok in self.__samples if ok)
+        return {
+            "samples": total,
+            "error_rate": (total - len(latencies)) / total if total else 0.0,
+            "mean_latency": sum(latencies) / len(latencies) if latencies else None,
+        }
+
+
+class BackendRouter:
+    """按滑动窗口内的延迟与错误率为等价后端排序"""
+
+    def __init__(self, window_size: int, window_time: float, error_penalty: float):
+        self.window_size = window_size
+        self.window_time = window_time
+        self.error_penalty = error_penalty
+        self.failovers = 0
+        self.__stats: dict[ModelBackend, BackendStats] = {}
+
+    def __get(self, backend: ModelBackend) -> BackendStats:
+        if backend not in self.__stats:
+            self.__stats[backend] = BackendStats(self.window_size, self.window_time)
+        return self.__stats[backend]
+
+    def rank(
+        self,
+        backends: Iterable[ModelBackend],
+        available: Callable[[ModelBackend], bool] = lambda _: True,
+    ) -> list[ModelBackend]:
+        """可用的后端排在前面，得分相同时保持配置顺序"""
+        return sorted(
+            backends,
+            key=lambda backend: (
+                not available(backend),
+                self.__get(backend).score(self.error_penalty),
+            ),
+        )
+
+    def record(self, backend: ModelBackend, latency: float, ok: bool):
+        self.__get(backend).record(latency, ok)
+
+    def stats(self) -> dict:
+        return {
+            "failovers": self.failovers,
+            "backends": {
+                "{0}/{1}".format(backend.provider, backend.model_called): stats.stats()
+                for backend, stats in self.__stats.items()
+            },
+        }
@@ -0,0 +1,58 @@
+from typing import Awaitable, Callable, TypeVar
+import asyncio
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """合并相同key的并发调用：同一时刻只执行一次，其余调用等待同一个结果"""
+
+    def __init__(self):
+        self.leaders = 0
+        self.coalesced = 0
+        self.__calls: dict[str, asyncio.Future] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> tuple[T, bool]:
+        """执行或等待key对应的调用
+
+        Returns:
+            result: 调用结果
+            shared: 是否复用了其他请求的结果
+        """
+        future = self.__calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(future), True
+            except asyncio.CancelledError:
+                # 发起调用的请求被取消时自行执行
+                if not future.cancelled():
+                    raise
+                return await fn(), False
+
+        future = asyncio.get_running_loop().create_future()
+        # 没有等待者时避免 "exception was never retrieved" 警告
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.__calls[key] = future
+        self.leaders += 1
+        try:
+            result = await fn()
+            future.set_result(result)
+            return result, False
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self.__calls[key]
+
+    def stats(self) -> dict:
+        total = self.leaders + self.coalesced
+        return {
+            "in_flight": len(self.__calls),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "coalesced_rate": self.coalesced / total if total else 0.0,
+        }
@@ -0,0 +1,44 @@
+# 本地token估算，无需请求上游即可判断输入是否超出模型的上下文窗口
+# 估算偏保守：CJK字符按每字1个token，其余字符按每4字符1个token
+import math
+import re
+
+CJK_PATTERN = re.compile(
+    "[\u2e80-\u2fff\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff"
+    "\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]"
+)
+
+# 每条消息的格式开销（role、分隔符等）
+MESSAGE_OVERHEAD = 4
+# 每次请求回复的起始开销
+REPLY_PRIMING = 3
+# 每张图片按高精度模式估算
+IMAGE_TOKENS = 765
+
+
+def estimate_text_tokens(text: str) -> int:
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def estimate_content_tokens(content) -> int:
+    """估算input_list中单条消息content的token数（str或多模态list）"""
+    if isinstance(content, str):
+        return estimate_text_tokens(content) + MESSAGE_OVERHEAD
+
+    tokens = MESSAGE_OVERHEAD
+    for part in content:
+        if part["type"] == "text":
+            tokens += estimate_text_tokens(part["text"])
+        else:
+            tokens += IMAGE_TOKENS
+    return tokens
+
+
+def truncate_text(text: str, tokens: int) -> str:
+    """保留文本末尾约tokens个token的内容"""
+    total = estimate_text_tokens(text)
+    if total <= tokens:
+        return text
+    keep = max(int(len(text) * tokens / total), 0)
+    return "…" + text[len(text) - keep :] if keep else ""
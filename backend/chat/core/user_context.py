@@ -0,0 +1,67 @@
+from ..models import UserPreference
+from .errors import ChatError
+from .db import db_reader
+from .configs import USER_CONTEXT_CACHE, USER_CONTEXT_TTL
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from dataclasses import dataclass
+from oauth.models import UserProfile
+
+
+@dataclass
+class UserContext:
+    """一次请求中共用的用户数据（身份、偏好设置）"""
+
+    profile: UserProfile
+    preference: UserPreference
+
+
+def __cache_key(user_id: int) -> str:
+    return "user_context:{0}".format(user_id)
+
+
+def load_user_context(request) -> UserContext:
+    """
+    获取当前用户的 UserContext：同一请求内只加载一次，跨请求缓存 USER_CONTEXT_TTL 秒，
+    未命中时用一次 select_related 查询读取。结果只用于读取，修改须重新从数据库读取
+    Error:
+        ChatError: 用户信息不完整时抛出，status 404
+    """
+    context = getattr(request, "_chat_user_context", None)
+    if context is not None:
+        return context
+
+    user_id = request.user.id
+    cache = caches[USER_CONTEXT_CACHE]
+    context = cache.get(__cache_key(user_id))
+    if context is None:
+        try:
+            user = User.objects.select_related("userprofile", "userpreference").get(
+                id=user_id
+            )
+            context = UserContext(
+                profile=user.userprofile, preference=user.userpreference
+            )
+        except (
+            User.DoesNotExist,
+            UserProfile.DoesNotExist,
+            UserPreference.DoesNotExist,
+        ):
+            raise ChatError("用户信息错误", status=404)
+        cache.set(__cache_key(user_id), context, timeout=USER_CONTEXT_TTL)
+
+    request._chat_user_context = context
+    return context
+
+
+async def aload_user_context(request) -> UserContext:
+    context = getattr(request, "_chat_user_context", None)
+    if context is not None:
+        return context
+    return await db_reader(load_user_context)(request)
+
+
+def invalidate_user_context(user_id: int):
+    """用户的身份或偏好设置被修改后调用"""
+    caches[USER_CONTEXT_CACHE].delete(__cache_key(user_id))
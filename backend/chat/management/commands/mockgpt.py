@@ -0,0 +1,28 @@
+from chat.core.mock import MOCK_PROFILES, build_stub_app
+
+from django.core.management.base import BaseCommand
+from aiohttp import web
+
+
+class Command(BaseCommand):
+    help = "运行本地OpenAI兼容的模拟服务（/v1/chat/completions），用于端到端压测"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument(
+            "--profile", choices=sorted(MOCK_PROFILES), default="realistic"
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            "Mock upstream ({0}) on http://{1}:{2}/v1".format(
+                options["profile"], options["host"], options["port"]
+            )
+        )
+        web.run_app(
+            build_stub_app(MOCK_PROFILES[options["profile"]]),
+            host=options["host"],
+            port=options["port"],
+            print=None,
+        )
@@ -0,0 +1,79 @@
+from chat.models import Message, UsageRollup
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, Q, Sum, Value
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+import datetime
+
+
+def parse_day(value: str) -> datetime.date:
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise CommandError("日期格式应为 YYYY-MM-DD: {0}".format(value))
+
+
+class Command(BaseCommand):
+    help = "从 Message 表重新计算用量汇总（UsageRollup），用于回填或修正"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--since", type=parse_day, help="起始日期（含），默认全部")
+        parser.add_argument("--until", type=parse_day, help="结束日期（含），默认全部")
+
+    def handle(self, *args, **options):
+        since, until = options["since"], options["until"]
+
+        messages = Message.objects.filter(sender=0)
+        rollups = UsageRollup.objects.all()
+        tz = timezone.get_current_timezone()
+        if since is not None:
+            messages = messages.filter(
+                timestamp__gte=datetime.datetime.combine(since, datetime.time(), tz)
+            )
+            rollups = rollups.filter(day__gte=since)
+        if until is not None:
+            messages = messages.filter(
+                timestamp__lt=datetime.datetime.combine(
+                    until + datetime.timedelta(days=1), datetime.time(), tz
+                )
+            )
+            rollups = rollups.filter(day__lte=until)
+
+        rows = (
+            messages.annotate(
+                day=TruncDate("timestamp", tzinfo=tz),
+                user_type=Coalesce("session__user__userprofile__user_type", Value("")),
+            )
+            .values("day", "use_model", "user_type")
+            .annotate(
+                llm_messages=Count("id", filter=Q(flag_qcmd=False)),
+                qcmd_messages=Count("id", filter=Q(flag_qcmd=True)),
+                prompt_tokens=Coalesce(Sum("prompt_tokens"), 0),
+                completion_tokens=Coalesce(Sum("completion_tokens"), 0),
+            )
+            .order_by()
+        )
+
+        with transaction.atomic():
+            deleted, _ = rollups.delete()
+            created = UsageRollup.objects.bulk_create(
+                [
+                    UsageRollup(
+                        day=row["day"],
+                        model=row["use_model"],
+                        user_type=row["user_type"],
+                        llm_messages=row["llm_messages"],
+                        qcmd_messages=row["qcmd_messages"],
+                        prompt_tokens=row["prompt_tokens"],
+                        completion_tokens=row["completion_tokens"],
+                    )
+                    for row in rows.iterator()
+                ],
+                batch_size=500,
+            )
+
+        self.stdout.write(
+            "Replaced {0} rollup rows with {1}".format(deleted, len(created))
+        )
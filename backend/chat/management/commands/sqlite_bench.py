@@ -0,0 +1,110 @@
+from chat.core.db import db_reader, db_writer
+from chat.models import Message, Session, UserAccount
+
+from asgiref.sync import ThreadSensitiveContext, sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, close_old_connections, connection, transaction
+from django.db.models import F
+import asyncio
+import statistics
+import time
+
+
+def write_round(session: Session, account: UserAccount):
+    """与保存一轮对话相近的写操作"""
+    with transaction.atomic():
+        Message.objects.create(sender=1, session=session, content="bench")
+        Message.objects.create(sender=0, session=session, content="bench" * 50)
+        UserAccount.objects.filter(id=account.id).update(
+            usage_count=F("usage_count") + 1
+        )
+
+
+def read_history(session: Session):
+    """与构建上下文相近的读操作"""
+    return list(session.message_set.order_by("-timestamp")[:8])
+
+
+async def as_request(operation):
+    """与 ASGIHandler 相同：每个请求有自己的同步线程与数据库连接，结束时关闭连接"""
+    async with ThreadSensitiveContext():
+        try:
+            return await operation()
+        finally:
+            await sync_to_async(close_old_connections)()
+
+
+def percentile(samples: list[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    return statistics.quantiles(samples, n=100, method="inclusive")[q - 1]
+
+
+class Command(BaseCommand):
+    help = (
+        "并发读写基准测试，对比 SQLITE_PRODUCTION=0/1 下的延迟与锁错误"
+        "（会创建并在结束后删除一个临时用户）"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--writers", type=int, default=8)
+        parser.add_argument("--readers", type=int, default=32)
+        parser.add_argument("--rounds", type=int, default=50, help="每个任务的操作次数")
+
+    def handle(self, *args, **options):
+        user = User.objects.create(username="sqlite-bench-{0}".format(time.time_ns()))
+        session = Session.objects.create(user=user, name="bench")
+        account = UserAccount.objects.create(user=user)
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("PRAGMA journal_mode")
+                journal_mode = cursor.fetchone()[0]
+            result = asyncio.run(self.run(session, account, options))
+        finally:
+            user.delete()
+
+        self.stdout.write(
+            "SQLITE_PRODUCTION={0} journal_mode={1}".format(
+                settings.SQLITE_PRODUCTION, journal_mode
+            )
+        )
+        self.stdout.write("elapsed {0:.2f}s".format(result["elapsed"]))
+        for kind in ("write", "read"):
+            samples = result[kind]
+            self.stdout.write(
+                "{0}: {1} ops, {2:.0f} ops/s, p50 {3:.1f}ms, p95 {4:.1f}ms, "
+                "max {5:.1f}ms, locked errors {6}".format(
+                    kind,
+                    len(samples),
+                    len(samples) / result["elapsed"],
+                    percentile(samples, 50) * 1000,
+                    percentile(samples, 95) * 1000,
+                    max(samples, default=0) * 1000,
+                    result["errors"][kind],
+                )
+            )
+
+    async def run(self, session: Session, account: UserAccount, options) -> dict:
+        result = {"write": [], "read": [], "errors": {"write": 0, "read": 0}}
+
+        async def worker(kind: str, operation):
+            for _ in range(options["rounds"]):
+                start = time.monotonic()
+                try:
+                    await as_request(operation)
+                    result[kind].append(time.monotonic() - start)
+                except OperationalError:
+                    result["errors"][kind] += 1
+
+        write = lambda: db_writer(write_round)(session, account)
+        read = lambda: db_reader(read_history)(session)
+
+        start = time.monotonic()
+        await asyncio.gather(
+            *[worker("write", write) for _ in range(options["writers"])],
+            *[worker("read", read) for _ in range(options["readers"])],
+        )
+        result["elapsed"] = time.monotonic() - start
+        return result
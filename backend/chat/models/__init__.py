@@ -2,3 +2,4 @@ from .message import *
 from .session import *
 from .user import *
 from .blob import *
+from .usage import *
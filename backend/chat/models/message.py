@@ -7,6 +7,29 @@ class Message(models.Model):
     class Meta:
         verbose_name = "消息"
         verbose_name_plural = verbose_name
+        indexes = [
+            # 按 (timestamp, id) 分页读取会话历史
+            models.Index(
+                fields=["session", "timestamp", "id"], name="message_session_page_idx"
+            ),
+            # 增量同步
+            models.Index(
+                fields=["session", "updated_time"], name="message_session_sync_idx"
+            ),
+            # 最近一条用户消息/回复、重新生成时标记旧回复、会话列表的轮数与最后回复时间
+            # regenerated=False 会被编译为 NOT regenerated，无法作为索引列匹配，
+            # 由从新到旧扫描时过滤（通常只需检查最近几条）
+            models.Index(
+                fields=["session", "sender", "timestamp"],
+                name="message_sender_idx",
+            ),
+            # 构建上下文时读取最近n条历史（默认不附带重新生成的消息），使用部分索引
+            models.Index(
+                fields=["session", "timestamp"],
+                condition=models.Q(regenerated=False),
+                name="message_history_idx",
+            ),
+        ]
 
     # AI-0 , User-1
     sender = models.IntegerField(verbose_name="发送者")
@@ -24,7 +47,19 @@ class Message(models.Model):
     prompt_tokens = models.IntegerField(verbose_name="请求prompt token用量", default=0)
     completion_tokens = models.IntegerField(verbose_name="回复补全 token用量", default=0)
     has_blob = models.BooleanField(verbose_name="是否有附件", default=False)
-    blobs = []
+    content_tokens = models.IntegerField(
+        verbose_name="内容token估计", null=True, blank=True, default=None
+    )
+    # 最后修改时间，用于增量同步；使用 QuerySet.update 修改时需要手动设置
+    updated_time = models.DateTimeField(verbose_name="修改时间", default=timezone.now)
+    # 附件地址列表，由 Session.get_recent_n 填充
+    blobs: list[str] = []
 
     def __str__(self):
         return self.content
+
+    def save(self, *args, **kwargs):
+        self.updated_time = timezone.now()
+        if kwargs.get("update_fields") is not None:
+            kwargs["update_fields"] = {*kwargs["update_fields"], "updated_time"}
+        super().save(*args, **kwargs)
@@ -1,8 +1,8 @@
 from typing import Any, Union
 from django.db import models
+from django.db.models import Count, Max, Q
 from django.contrib.auth.models import User
 from django.utils import timezone
-from asgiref.sync import sync_to_async
 from dataclasses import dataclass
 
 
@@ -15,7 +15,20 @@ class SessionContext:
     before: timezone.datetime
 
 
+class SessionQuerySet(models.QuerySet):
+    def with_stats(self):
+        """
+        附带回复轮数 rounds 与最后回复时间 last_reply_time，供 SessionSerializer 使用
+        """
+        return self.annotate(
+            rounds=Count("message", filter=Q(message__sender=0)),
+            last_reply_time=Max("message__timestamp", filter=Q(message__sender=0)),
+        )
+
+
 class Session(models.Model):
+    objects = SessionQuerySet.as_manager()
+
     class Meta:
         verbose_name = "会话"
         verbose_name_plural = verbose_name
@@ -24,18 +37,32 @@ class Session(models.Model):
     name = models.CharField(max_length=30)
     # 是否被改名过（不直接检测名称是否为默认，保证用户改回为默认的情况）
     is_renamed = models.BooleanField(default=False)
+    # 是否正在后台生成会话标题
+    title_pending = models.BooleanField(default=False)
     created_time = models.DateTimeField(
         default=timezone.now, db_index=True, editable=True
     )
     deleted_time = models.DateTimeField(blank=True, null=True, editable=True)
+    # 会话列表中可见内容（名称、轮数、删除）的最后修改时间，用于增量同步
+    # 使用 QuerySet.update 修改时需要手动设置
+    modified_time = models.DateTimeField(default=timezone.now, db_index=True)
 
     def __str__(self):
         return f"{self.user} : {self.name}"
 
+    def save(self, *args, **kwargs):
+        self.modified_time = timezone.now()
+        if kwargs.get("update_fields") is not None:
+            kwargs["update_fields"] = {*kwargs["update_fields"], "modified_time"}
+        super().save(*args, **kwargs)
+
     async def get_recent_n(
         self,
         sessionContext: SessionContext,
     ):  # 获取最近n条
+        # chat.core 依赖 chat.models，在调用时导入
+        from ..core.db import db_reader
+
         def __request_recent_n(n: int):
             filters: dict[str, Union[bool, timezone.datetime]] = {
                 "timestamp__lt": sessionContext.before
@@ -45,14 +72,23 @@ class Session(models.Model):
                 filters["flag_qcmd"] = False
             if not sessionContext.with_regenerated:
                 filters["regenerated"] = False
-            messages = list(self.message_set.filter(**filters).order_by("-timestamp")[:sessionContext.n])
+            messages = self.message_set.filter(**filters).order_by("-timestamp")
+            if sessionContext.with_blobs:
+                # 一次IN查询取回所有附件
+                messages = messages.prefetch_related("blob_set")
+            messages = list(messages[:sessionContext.n])
 
             if sessionContext.with_blobs:
                 for message in messages:
-                    message.blobs = list(message.blob_set.order_by("-timestamp").all())
+                    blobs = sorted(
+                        message.blob_set.all(),
+                        key=lambda blob: blob.timestamp,
+                        reverse=True,
+                    )
+                    message.blobs = [blob.location for blob in blobs]
             return messages
 
-        messages = await sync_to_async(__request_recent_n)(sessionContext.n)
+        messages = await db_reader(__request_recent_n)(sessionContext.n)
 
         return messages[::-1]
 
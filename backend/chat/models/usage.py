@@ -0,0 +1,55 @@
+from django.db import models, transaction, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+
+
+class UsageRollup(models.Model):
+    """按（日期, 模型, 用户类型）预聚合的用量，避免统计时扫描 Message 表"""
+
+    class Meta:
+        verbose_name = "用量汇总"
+        verbose_name_plural = verbose_name
+        constraints = [
+            models.UniqueConstraint(
+                fields=["day", "model", "user_type"], name="unique_usage_rollup"
+            )
+        ]
+
+    day = models.DateField(verbose_name="日期", db_index=True)
+    # 快捷指令回复的模型为空
+    model = models.CharField(verbose_name="模型", max_length=50, default="")
+    user_type = models.CharField(verbose_name="用户类型", max_length=50, default="")
+    llm_messages = models.IntegerField(verbose_name="模型回复数", default=0)
+    qcmd_messages = models.IntegerField(verbose_name="快捷指令回复数", default=0)
+    prompt_tokens = models.BigIntegerField(verbose_name="请求prompt token用量", default=0)
+    completion_tokens = models.BigIntegerField(
+        verbose_name="回复补全 token用量", default=0
+    )
+
+    def __str__(self):
+        return f"{self.day} {self.model} {self.user_type}"
+
+    @classmethod
+    def record(cls, message, user_type: str):
+        """将一条已保存的回复计入当日汇总，需在事务中调用"""
+        key = {
+            "day": timezone.localtime(message.timestamp).date(),
+            "model": message.use_model,
+            "user_type": user_type,
+        }
+        delta = {
+            "llm_messages": 0 if message.flag_qcmd else 1,
+            "qcmd_messages": 1 if message.flag_qcmd else 0,
+            "prompt_tokens": message.prompt_tokens,
+            "completion_tokens": message.completion_tokens,
+        }
+        increments = {name: F(name) + value for name, value in delta.items()}
+
+        if cls.objects.filter(**key).update(**increments):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(**key, **delta)
+        except IntegrityError:
+            # 并发请求先创建了同一行
+            cls.objects.filter(**key).update(**increments)
@@ -9,6 +9,7 @@ class MessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
         fields = [
+            "id",
             "sender",
             "content",
             "flag_qcmd",
@@ -21,5 +22,6 @@ class MessageSerializer(serializers.ModelSerializer):
             "regenerated",
         ]
 
+    # 列表请对 blob_set 使用 prefetch_related，否则每条消息额外查询一次
     def get_image_urls(self, obj):
         return list(map(lambda x: x.location, obj.blob_set.all()))
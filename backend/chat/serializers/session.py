@@ -15,11 +15,17 @@ class SessionSerializer(serializers.ModelSerializer):
             'updated_time',
             ]
     
+    # 列表请使用 Session.objects.with_stats()，否则每个会话额外查询两次
+
     def get_rounds(self, obj):
+        if hasattr(obj, 'rounds'):
+            return obj.rounds
         return obj.message_set.filter(sender = 0).count()
 
     def get_updated_time(self, obj):
-        try:
-            return obj.message_set.filter(sender = 0).order_by('-timestamp').first().timestamp.isoformat()
-        except AttributeError as _ :
-            return obj.created_time.isoformat()
+        if hasattr(obj, 'last_reply_time'):
+            last_reply_time = obj.last_reply_time
+        else:
+            last_reply = obj.message_set.filter(sender = 0).order_by('-timestamp').first()
+            last_reply_time = last_reply.timestamp if last_reply else None
+        return (last_reply_time or obj.created_time).isoformat()
@@ -1,3 +1,575 @@
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from unittest import mock, skipUnless
+from django.contrib.auth.models import User
+from django.utils import timezone
+from django.db.models import F
+from django.core.exceptions import ImproperlyConfigured
 
-# Create your tests here.
+from chat.models import (
+    Session,
+    SessionContext,
+    Message,
+    Blob,
+    UserAccount,
+    UserPreference,
+)
+from chat.core.quota import QuotaLedger
+from chat.core.resilience import (
+    AdaptiveLimiter,
+    CircuitBreaker,
+    ProviderGuard,
+    ProviderUnavailable,
+)
+from chat.core.gpt import (
+    FunctionCallAdapter,
+    GPTConnectionFactory,
+    MockGPTConnection,
+    completion_cache,
+)
+from chat.core.errors import ChatError
+from chat.core.plugins.fc import FCSpec
+from chat.core.user_context import invalidate_user_context
+from oauth.models import UserProfile
+from chat.serializers import SessionSerializer, MessageSerializer
+from asgiref.sync import async_to_sync
+
+import datetime
+import dateutil.parser
+import asyncio
+import base64
+
+
+class SessionListQueryTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="session-list")
+        start = timezone.now() - datetime.timedelta(days=1)
+        for i in range(5):
+            session = Session.objects.create(name=f"会话{i}", user=cls.user)
+            for j in range(i):
+                timestamp = start + datetime.timedelta(minutes=i * 10 + j)
+                Message.objects.create(
+                    sender=1, session=session, content="问", timestamp=timestamp
+                )
+                Message.objects.create(
+                    sender=0, session=session, content="答", timestamp=timestamp
+                )
+
+    def test_session_list_is_one_query(self):
+        sessions = Session.objects.filter(user=self.user).with_stats()
+        with self.assertNumQueries(1):
+            data = SessionSerializer(sessions, many=True).data
+
+        self.assertEqual(len(data), 5)
+        for item in data:
+            session = Session.objects.get(id=item["id"])
+            replies = session.message_set.filter(sender=0).order_by("-timestamp")
+            self.assertEqual(item["rounds"], replies.count())
+            expected = replies.first().timestamp if replies else session.created_time
+            self.assertEqual(item["updated_time"], expected.isoformat())
+
+
+class MessageBlobQueryTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="message-blobs")
+        cls.session = Session.objects.create(name="会话", user=cls.user)
+        start = timezone.now() - datetime.timedelta(days=1)
+        for i in range(6):
+            message = Message.objects.create(
+                sender=1,
+                session=cls.session,
+                content="图",
+                has_blob=True,
+                timestamp=start + datetime.timedelta(minutes=i),
+            )
+            Blob.objects.create(message=message, location=f"https://img/{i}.png")
+
+    def test_message_list_prefetches_blobs(self):
+        messages = Message.objects.filter(session=self.session).prefetch_related(
+            "blob_set"
+        )
+        with self.assertNumQueries(2):
+            data = MessageSerializer(messages, many=True).data
+        self.assertEqual(data[0]["image_urls"], ["https://img/0.png"])
+
+    def test_recent_history_loads_blob_locations(self):
+        context = SessionContext(
+            n=4,
+            with_qcmd=True,
+            with_regenerated=True,
+            with_blobs=True,
+            before=timezone.now(),
+        )
+        with self.assertNumQueries(2):
+            messages = async_to_sync(self.session.get_recent_n)(context)
+        self.assertEqual(
+            [message.blobs for message in messages],
+            [[f"https://img/{i}.png"] for i in range(2, 6)],
+        )
+
+
+class UserContextQueryTest(TestCase):
+    """用户身份与偏好设置每个请求只读取一次，修改后失效"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="user-context")
+        UserProfile.objects.create(user=cls.user, user_type="teacher")
+        # 不在后台生成标题，避免测试结束时留下未完成的任务
+        UserPreference.objects.create(user=cls.user, auto_generate_title=False)
+        UserAccount.objects.create(user=cls.user)
+        cls.session = Session.objects.create(name="会话", user=cls.user)
+
+    def setUp(self):
+        invalidate_user_context(self.user.id)
+        self.client.force_login(self.user)
+        self.async_client.force_login(self.user)
+
+    def user_queries(self, queries) -> list[str]:
+        return [
+            query["sql"]
+            for query in queries
+            if "userpreference" in query["sql"] or "userprofile" in query["sql"]
+        ]
+
+    @mock.patch("chat.core.base.OPENAI_MOCK", True)
+    def test_loaded_once_per_send(self):
+        data = {
+            "message": base64.b64encode("你好".encode()).decode(),
+            "model": "Idealab GPT4o Mini",
+        }
+        url = "/api/send-message/{0}/".format(self.session.id)
+
+        @async_to_sync
+        async def send():
+            return await self.async_client.post(
+                url, data, content_type="application/json"
+            )
+
+        with CaptureQueriesContext(connection) as queries:
+            response = send()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.user_queries(queries)), 1)
+
+        with CaptureQueriesContext(connection) as queries:
+            send()
+        self.assertEqual(self.user_queries(queries), [])
+
+    def test_patch_invalidates_and_keeps_other_fields(self):
+        self.assertEqual(
+            self.client.get("/api/user-preference/").json()["max_tokens"], 1000
+        )
+        # 缓存期间另一个进程修改了其他域
+        UserPreference.objects.filter(user=self.user).update(temperature=0.5)
+
+        response = self.client.patch(
+            "/api/user-preference/",
+            {"field": "max_tokens", "value": 500},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+
+        data = self.client.get("/api/user-preference/").json()
+        self.assertEqual(data["max_tokens"], 500)
+        self.assertEqual(data["temperature"], 0.5)
+
+    def test_patch_rejects_relation_fields(self):
+        response = self.client.patch(
+            "/api/user-preference/",
+            {"field": "user", "value": 1},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class DeltaSyncTest(TestCase):
+    """会话与消息的 ETag 和 since 增量同步"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="delta-sync")
+        cls.session = Session.objects.create(name="会话", user=cls.user)
+        cls.other = Session.objects.create(name="其他", user=cls.user)
+        Message.objects.create(sender=1, session=cls.session, content="问")
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def since(self, time: datetime.datetime) -> dict:
+        return {"since": time.isoformat()}
+
+    def test_sessions_etag(self):
+        response = self.client.get("/api/sessions/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 2)
+        etag = response["ETag"]
+
+        response = self.client.get("/api/sessions/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        Session.objects.create(name="新会话", user=self.user)
+        response = self.client.get("/api/sessions/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_sessions_since_returns_changes_and_deleted_ids(self):
+        past = timezone.now() - datetime.timedelta(hours=1)
+        Session.objects.filter(user=self.user).update(modified_time=past)
+        since = past + datetime.timedelta(minutes=1)
+
+        rename = "/api/sessions/rename/{0}/".format(self.session.id)
+        self.client.post(rename, {"new_name": "改名"})
+        self.client.delete("/api/sessions/{0}/".format(self.other.id))
+
+        data = self.client.get("/api/sessions/", self.since(since)).json()
+        self.assertEqual([item["id"] for item in data["sessions"]], [self.session.id])
+        self.assertEqual(data["sessions"][0]["name"], "改名")
+        self.assertEqual(data["deleted"], [self.other.id])
+
+    def test_sessions_since_rejects_malformed_time(self):
+        response = self.client.get("/api/sessions/", {"since": "yesterday"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_late_commit_is_returned_by_next_sync(self):
+        data = self.client.get("/api/sessions/", self.since(timezone.now())).json()
+        read_time = timezone.now()
+        watermark = dateutil.parser.isoparse(data["watermark"])
+        self.assertLess(watermark, read_time)
+
+        # 修改时间在上次读取之前生成，但在读取之后才提交
+        stamped = read_time - datetime.timedelta(seconds=1)
+        Session.objects.filter(id=self.other.id).update(
+            name="晚提交", modified_time=stamped
+        )
+        self.assertLess(watermark, stamped)
+
+        data = self.client.get("/api/sessions/", self.since(watermark)).json()
+        self.assertIn(self.other.id, [item["id"] for item in data["sessions"]])
+
+    def test_messages_since_and_etag(self):
+        url = "/api/sessions/{0}/messages/".format(self.session.id)
+        response = self.client.get(url)
+        self.assertEqual(len(response.json()), 1)
+        etag = response["ETag"]
+        self.assertEqual(
+            self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304
+        )
+
+        since = timezone.now()
+        reply = Message.objects.create(sender=0, session=self.session, content="答")
+        response = self.client.get(url, self.since(since), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([item["id"] for item in data["messages"]], [reply.id])
+        self.assertIn("watermark", data)
+
+
+class MessagePageTest(TestCase):
+    """按 (timestamp, id) 的游标分页"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="message-page")
+        cls.session = Session.objects.create(name="会话", user=cls.user)
+        start = timezone.now() - datetime.timedelta(days=1)
+        cls.messages = []
+        for i in range(7):
+            # 每两条消息的时间相同
+            timestamp = start + datetime.timedelta(minutes=i // 2)
+            message = Message.objects.create(
+                sender=i % 2, session=cls.session, content=str(i), timestamp=timestamp
+            )
+            cls.messages.append(message)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.url = "/api/sessions/{0}/messages/page/".format(self.session.id)
+
+    def cursor(self, raw: str) -> str:
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    def test_pages_cover_all_messages_once(self):
+        ids, before, pages = [], None, 0
+        while True:
+            params = {"limit": 2}
+            if before:
+                params["before"] = before
+            data = self.client.get(self.url, params).json()
+            ids += [item["id"] for item in data["messages"]]
+            before = data["before"]
+            pages += 1
+            if before is None:
+                break
+
+        self.assertEqual(pages, 4)
+        expected = sorted(
+            self.messages, key=lambda message: (message.timestamp, message.id)
+        )
+        self.assertEqual(ids, [message.id for message in reversed(expected)])
+
+    def test_last_page_has_no_cursor(self):
+        data = self.client.get(self.url, {"limit": 7}).json()
+        self.assertEqual(len(data["messages"]), 7)
+        self.assertIsNone(data["before"])
+
+    def test_same_timestamp_splits_by_id(self):
+        first, second = self.messages[2], self.messages[3]
+        self.assertEqual(first.timestamp, second.timestamp)
+        before = self.cursor("{0}|{1}".format(second.timestamp.isoformat(), second.id))
+        data = self.client.get(self.url, {"limit": 1, "before": before}).json()
+        self.assertEqual([item["id"] for item in data["messages"]], [first.id])
+
+    def test_malformed_cursor_is_rejected(self):
+        timestamp = self.messages[0].timestamp.isoformat()
+        for before in [
+            "not base64!",
+            self.cursor("garbage"),
+            self.cursor("{0}|abc".format(timestamp)),
+            self.cursor("yesterday|1"),
+            self.cursor("{0}|1|2".format(timestamp)),
+            self.cursor("{0}|{1}".format(timestamp, 2**70)),
+            self.cursor("2024-01-01T00:00:00|1"),
+            base64.urlsafe_b64encode(b"\xff\xfe|1").decode(),
+        ]:
+            with self.subTest(before=before):
+                response = self.client.get(self.url, {"before": before})
+                self.assertEqual(response.status_code, 400)
+
+    def test_bad_limit_is_rejected(self):
+        self.assertEqual(self.client.get(self.url, {"limit": "x"}).status_code, 400)
+
+
+@skipUnless(connection.vendor == "sqlite", "query plans are checked on SQLite")
+class MessageIndexPlanTest(TestCase):
+    """热点查询应使用对应的复合索引"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="message-index")
+        cls.session = Session.objects.create(name="会话", user=cls.user)
+
+    def assertUsesIndex(self, queryset, index: str):
+        plan = queryset.explain()
+        self.assertIn(index, plan)
+        self.assertNotIn("USE TEMP B-TREE FOR ORDER BY", plan)
+
+    def test_last_user_message(self):
+        self.assertUsesIndex(
+            Message.objects.filter(session=self.session, sender=1, regenerated=False)
+            .order_by("-timestamp")
+            .exclude(content="continue")[:1],
+            "message_sender_idx",
+        )
+
+    def test_last_ai_message(self):
+        self.assertUsesIndex(
+            Message.objects.filter(session=self.session, sender=0, generation__gt=0)
+            .order_by("-timestamp")[:1],
+            "message_sender_idx",
+        )
+
+    def test_recent_history(self):
+        self.assertUsesIndex(
+            self.session.message_set.filter(
+                timestamp__lt=timezone.now(), regenerated=False
+            ).order_by("-timestamp")[:4],
+            "message_history_idx",
+        )
+
+    def test_regenerate_marks_previous_replies(self):
+        plan = (
+            Message.objects.filter(
+                session=self.session,
+                sender=0,
+                regenerated=False,
+                timestamp__gt=timezone.now(),
+            ).explain()
+        )
+        self.assertIn("message_sender_idx", plan)
+        self.assertIn("timestamp>?", plan)
+
+
+class QuotaLedgerTest(TestCase):
+    """只有确认的次数写回数据库，且为累加而非覆盖"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="quota-ledger")
+        cls.account = UserAccount.objects.create(
+            user=cls.user, usage_count=3, last_used=timezone.localdate()
+        )
+
+    def setUp(self):
+        self.ledger = QuotaLedger(limit=20, cache_alias="quota", flush_interval=60)
+        self.ledger.cache.clear()
+
+    def test_flush_writes_committed_delta(self):
+        async def run():
+            reservations = [await self.ledger.reserve(self.user.id) for _ in range(30)]
+            granted = [r for r in reservations if r is not None]
+            self.assertEqual(len(granted), 17)
+            for reservation in granted[:10]:
+                self.ledger.commit(reservation)
+            for reservation in granted[10:]:
+                await self.ledger.release(reservation)
+            # 其他进程在此期间写回的次数不被覆盖
+            await UserAccount.objects.filter(user=self.user).aupdate(
+                usage_count=F("usage_count") + 2
+            )
+            await self.ledger.aclose()
+
+        async_to_sync(run)()
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.usage_count, 3 + 2 + 10)
+
+    def test_flush_resets_on_new_day(self):
+        yesterday = timezone.localdate() - datetime.timedelta(days=1)
+        UserAccount.objects.filter(user=self.user).update(last_used=yesterday)
+
+        async def run():
+            self.ledger.commit(await self.ledger.reserve(self.user.id))
+            await self.ledger.aclose()
+
+        async_to_sync(run)()
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.usage_count, 1)
+        self.assertEqual(self.account.last_used, timezone.localdate())
+
+    def test_flush_at_exit_writes_pending(self):
+        async def run():
+            self.ledger.commit(await self.ledger.reserve(self.user.id))
+
+        async_to_sync(run)()
+        self.ledger.flush_at_exit()
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.usage_count, 3 + 1)
+
+    def test_process_local_cache_rejects_multiple_workers(self):
+        self.ledger.check_deployment(1)
+        with self.assertRaises(ImproperlyConfigured):
+            self.ledger.check_deployment(4)
+
+
+class CompletionCacheRegenTest(TestCase):
+    """重新生成的输入与原请求相同，仍须重新请求上游"""
+
+    def setUp(self):
+        completion_cache.clear()
+        self.calls = 0
+
+    async def interact(self, *args, **kwargs) -> Message:
+        self.calls += 1
+        return Message(sender=0, content="回复{0}".format(self.calls))
+
+    def send(self, regen: bool) -> Message:
+        connection = (
+            GPTConnectionFactory()
+            .model_engine("Idealab GPT4o Mini")
+            .mock(True)
+            .coalesce(True)
+            .cache(True)
+            .regen(regen)
+            .build()
+        )
+        msg = [{"role": "user", "content": "你好"}]
+        return async_to_sync(connection.interact)(msg, temperature=0)
+
+    def test_regenerate_skips_cache(self):
+        with mock.patch.object(MockGPTConnection, "interact", self.interact):
+            self.assertEqual(self.send(regen=False).content, "回复1")
+            self.assertEqual(self.send(regen=False).content, "回复1")
+            self.assertEqual(self.calls, 1)
+
+            self.assertEqual(self.send(regen=True).content, "回复2")
+            self.assertEqual(self.calls, 2)
+
+
+class ProviderGuardTest(TestCase):
+    """并发名额不足时不占用熔断器的探测名额"""
+
+    def test_limiter_rejection_keeps_probe_available(self):
+        breaker = CircuitBreaker(failure_threshold=1, recovery_time=0)
+        guard = ProviderGuard(breaker, AdaptiveLimiter(1, 1, 1))
+        breaker.record_failure()
+
+        guard.limiter.inflight = 1
+        with self.assertRaises(ProviderUnavailable):
+            with guard.slot():
+                pass
+        guard.limiter.inflight = 0
+
+        with guard.slot() as call:
+            call.outcome = ProviderGuard.SUCCESS
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_breaker_rejection_releases_limiter(self):
+        breaker = CircuitBreaker(failure_threshold=1, recovery_time=60)
+        guard = ProviderGuard(breaker, AdaptiveLimiter(1, 1, 1))
+        breaker.record_failure()
+
+        with self.assertRaises(ProviderUnavailable):
+            with guard.slot():
+                pass
+        self.assertEqual(guard.limiter.inflight, 0)
+
+
+class FunctionCallAdapterTest(TestCase):
+    """任一函数调用失败时取消其余调用"""
+
+    def test_failure_cancels_other_calls(self):
+        cancelled = []
+
+        async def slow(arguments: str) -> tuple[bool, str]:
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(arguments)
+                raise
+            return True, "ok"
+
+        async def fail(arguments: str) -> tuple[bool, str]:
+            return False, "插件错误"
+
+        def spec(name: str, exec) -> FCSpec:
+            definition = mock.Mock()
+            definition.name = name
+            return FCSpec(exec=exec, group_id="test", definition=definition)
+
+        async def gpt(msg: list) -> dict:
+            raise AssertionError("不应再次请求模型")
+
+        adapter = FunctionCallAdapter(
+            "Idealab GPT4o Mini",
+            {"slow": spec("slow", slow), "fail": spec("fail", fail)},
+            gpt,
+        )
+        response = {
+            "choices": [
+                {
+                    "message": {
+                        "content": None,
+                        "tool_calls": [
+                            {
+                                "id": "1",
+                                "function": {"name": "slow", "arguments": "a"},
+                            },
+                            {
+                                "id": "2",
+                                "function": {"name": "fail", "arguments": "b"},
+                            },
+                        ],
+                    }
+                }
+            ]
+        }
+
+        async def run():
+            with self.assertRaisesMessage(ChatError, "插件错误"):
+                await adapter([], response)
+            # 返回前其余调用已经结束，而不是留在事件循环中继续运行
+            self.assertEqual(cancelled, ["a"])
+
+        async_to_sync(run)()
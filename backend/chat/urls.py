@@ -15,6 +15,18 @@ urlpatterns = [
         views.session_messages,
         name="session_messages",
     ),
+    # 分页获取会话中的消息（从新到旧，before 游标） GET
+    path(
+        "sessions/<int:session_id>/messages/page/",
+        views.session_messages_page,
+        name="session_messages_page",
+    ),
+    # 获取会话标题（后台生成标题时轮询） GET
+    path(
+        "sessions/<int:session_id>/title/",
+        views.session_title,
+        name="session_title",
+    ),
     # 删除会话 DELETE
     path("sessions/<int:session_id>/", views.delete_session, name="delete_session"),
     # 删除所有会话 DELETE
@@ -42,10 +54,22 @@ urlpatterns = [
     ),
     # 发送消息 POST
     path("send-message/<int:session_id>/", views.send_message, name="send_message"),
+    # 流式发送消息 POST (text/event-stream)
+    path(
+        "send-message/<int:session_id>/stream/",
+        views.send_message_stream,
+        name="send_message_stream",
+    ),
     # 读取或修改用户偏好 GET POST
     path("user-preference/", views.user_preference, name="user_preference"),
     # 读取插件列表
     path("list-plugins/", views.list_plugins, name="list_plugins"),
     # 读取模型列表
-    path("list-models/", views.list_models, name="list_models")
+    path("list-models/", views.list_models, name="list_models"),
+    # 运行时统计（管理员） GET
+    path("stats/", views.runtime_stats, name="runtime_stats"),
+    # 用量汇总（管理员） GET
+    path("usage/", views.usage_rollups, name="usage_rollups"),
+    # Prometheus指标 GET
+    path("metrics/", views.metrics, name="metrics"),
 ]
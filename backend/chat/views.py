@@ -9,39 +9,54 @@ from chat.models import (
     Session,
     Message,
     SessionShared,
-    UserAccount,
     UserPreference,
     Blob,
+    UsageRollup,
 )
 from chat.core import (
     STUDENT_LIMIT,
     handle_message,
+    handle_qcmd,
     summary_title,
     senword_detector_strict,
 )
 from .core.base import GPTPermission, GPTContext, GPTRequest
 from .core.errors import ChatError
 from .core.plugin import plugins_list_serialized
-from .core.configs import CHAT_MODELS, ModelCap
+from .core.plugins.qcmd import qcmd_cache
+from .core.gpt import (
+    completion_cache,
+    inflight_requests,
+    provider_guards,
+    backend_router,
+)
+from .core.tokens import estimate_text_tokens
+from .core.db import db_reader, db_writer
+from .core.quota import quota_ledger
+from .core.user_context import aload_user_context, invalidate_user_context
+from .core.metrics import DB_SECONDS, registry as metrics_registry
+from .core.configs import CHAT_MODELS, METRICS_TOKEN, SYNC_WATERMARK_LAG, ModelCap
 from oauth.models import UserProfile
 
 from rest_framework.decorators import authentication_classes, permission_classes
 from rest_framework.authentication import SessionAuthentication
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAuthenticated, IsAdminUser
 from django.contrib.admin.options import transaction
 from django.forms.utils import ValidationError
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.utils import timezone
-from django.db.models import F
-from asgiref.sync import sync_to_async
+from django.db.models import Count, Max, Q, Sum
 from adrf.decorators import api_view
 
 from dataclasses import asdict
-from typing import Union
+from typing import Optional, Union
 import logging
+import asyncio
+import datetime
 import dateutil.parser
 import django.db
 import base64
+import hmac
 import json
 import mmh3
 
@@ -55,24 +70,87 @@ import mmh3
 logger = logging.getLogger(__name__)
 
 
+# 增量同步：响应带有 ETag，If-None-Match 匹配时返回 304；
+# 带 since（上次返回的 watermark）时只返回此后新增或修改的内容。
+# 修改时间在写事务内生成，可能在本次读取之后才提交，因此 watermark 比读取时刻
+# 提前 SYNC_WATERMARK_LAG 秒，下次同步会再次返回这段时间内的内容，客户端按 id 去重
+
+
+def __sync_etag(state: dict) -> str:
+    latest = state["latest"]
+    return 'W/"{0}-{1}"'.format(state["count"], latest.timestamp() if latest else 0)
+
+
+def __sync_watermark() -> datetime.datetime:
+    return timezone.now() - datetime.timedelta(seconds=SYNC_WATERMARK_LAG)
+
+
+def __parse_since(request) -> Optional[datetime.datetime]:
+    since = request.query_params.get("since")
+    if not since:
+        return None
+    try:
+        return dateutil.parser.isoparse(since)
+    except ValueError:
+        raise ChatError("since 格式错误", status=400)
+
+
+def __not_modified(request, etag: str) -> Optional[HttpResponse]:
+    if request.headers.get("If-None-Match") == etag:
+        response = HttpResponse(status=304)
+        response["ETag"] = etag
+        return response
+    return None
+
+
 @api_view(["GET", "POST"])
 @authentication_classes([SessionAuthentication])
 @permission_classes([IsAuthenticated])
 async def sessions(request):
     if request.method == "GET":
         user = request.user  # 从request.user获取当前用户
-        sessions = await sync_to_async(
-            lambda: Session.objects.filter(user=user, deleted_time__isnull=True).all()
-        )()
-        data = await sync_to_async(
-            lambda sessions: SessionSerializer(sessions, many=True).data
-        )(sessions)
-        return JsonResponse(data, safe=False)
+        try:
+            since = __parse_since(request)
+        except ChatError as e:
+            serializer = ChatErrorSerializer(e)
+            return JsonResponse(serializer.data, status=e.status)
+
+        watermark = __sync_watermark()
+        sessions = Session.objects.filter(user=user)
+        etag = __sync_etag(
+            await sessions.aaggregate(count=Count("id"), latest=Max("modified_time"))
+        )
+        if (response := __not_modified(request, etag)) is not None:
+            return response
+
+        if since is None:
+            sessions = sessions.filter(deleted_time__isnull=True).with_stats()
+            data = await db_reader(
+                lambda sessions: SessionSerializer(sessions, many=True).data
+            )(sessions)
+        else:
+            changed = sessions.filter(modified_time__gte=since)
+            data = {
+                "sessions": await db_reader(
+                    lambda sessions: SessionSerializer(sessions, many=True).data
+                )(changed.filter(deleted_time__isnull=True).with_stats()),
+                "deleted": [
+                    id
+                    async for id in changed.filter(
+                        deleted_time__isnull=False
+                    ).values_list("id", flat=True)
+                ],
+                "watermark": watermark.isoformat(),
+            }
+
+        response = JsonResponse(data, safe=False)
+        response["ETag"] = etag
+        return response
     elif request.method == "POST":
         # 创建新会话，并关联到当前用户
         user = request.user
-        session = await Session.objects.acreate(name="新会话", user=user)
-        data = await sync_to_async(lambda session: SessionSerializer(session).data)(
+        session = await db_writer(Session.objects.create)(name="新会话", user=user)
+        data = await db_reader(lambda session: SessionSerializer(session).data)(
             session
         )
         return JsonResponse(data)
@@ -91,7 +169,8 @@ async def delete_session(request, session_id):
         session = Session.objects.filter(
             id=session_id, user=request.user, deleted_time__isnull=True
         )
-        await sync_to_async(session.update)(deleted_time=timezone.now())
+        now = timezone.now()
+        await db_writer(session.update)(deleted_time=now, modified_time=now)
         return JsonResponse({"message": "成功删除会话"})
     except Session.DoesNotExist:
         return JsonResponse({"error": "会话不存在"}, status=404)
@@ -106,7 +185,8 @@ async def delete_session(request, session_id):
 async def delete_all_sessions(request):
     try:
         sessions = Session.objects.filter(user=request.user, deleted_time__isnull=True)
-        await sync_to_async(sessions.update)(deleted_time=timezone.now())
+        now = timezone.now()
+        await db_writer(sessions.update)(deleted_time=now, modified_time=now)
         return JsonResponse({"message": "All sessions deleted successfully"})
     except Session.DoesNotExist:
         return JsonResponse({"error": "会话不存在"}, status=404)
@@ -132,7 +212,8 @@ async def rename_session(request, session_id):
         )
         session.name = new_name
         session.is_renamed = True
-        await session.asave()
+        session.title_pending = False
+        await db_writer(session.save)()
         return JsonResponse({"message": "Session renamed successfully"})
     except Session.DoesNotExist:
         return JsonResponse({"error": "会话不存在"}, status=404)
@@ -145,6 +226,12 @@ async def rename_session(request, session_id):
 @authentication_classes([SessionAuthentication])
 @permission_classes([IsAuthenticated])
 async def session_messages(request, session_id):
+    try:
+        since = __parse_since(request)
+    except ChatError as e:
+        serializer = ChatErrorSerializer(e)
+        return JsonResponse(serializer.data, status=e.status)
+
     try:
         filters = {
             "session__id": session_id,
@@ -152,23 +239,128 @@ async def session_messages(request, session_id):
             "session__deleted_time__isnull": True,
         }
 
-        messages = await sync_to_async(
-            lambda: Message.objects.filter(**filters).order_by("timestamp").all()
+        watermark = __sync_watermark()
+        messages = Message.objects.filter(**filters)
+        etag = __sync_etag(
+            await messages.aaggregate(count=Count("id"), latest=Max("updated_time"))
+        )
+        if (response := __not_modified(request, etag)) is not None:
+            return response
+
+        if since is not None:
+            messages = messages.filter(updated_time__gte=since)
+        messages = await db_reader(
+            lambda: messages.order_by("timestamp").prefetch_related("blob_set")
         )()
 
-        data = await sync_to_async(
+        data = await db_reader(
             lambda messages: MessageSerializer(messages, many=True).data
         )(messages)
-        return JsonResponse(data, safe=False)
+        if since is not None:
+            data = {"messages": data, "watermark": watermark.isoformat()}
+
+        response = JsonResponse(data, safe=False)
+        response["ETag"] = etag
+        return response
     except UserPreference.DoesNotExist:
         return JsonResponse({"error": "用户不存在"}, status=404)
     except Session.DoesNotExist:
         return JsonResponse({"error": "会话不存在"}, status=404)
 
 
+# 分页获取会话中的消息，按 (timestamp, id) 从新到旧，before 为上一页返回的游标
+
+MESSAGE_PAGE_SIZE = 50
+MESSAGE_PAGE_SIZE_MAX = 200
+
+
+def __encode_message_cursor(message: Message) -> str:
+    raw = "{0}|{1}".format(message.timestamp.isoformat(), message.id)
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def __decode_message_cursor(cursor: str) -> Q:
+    try:
+        timestamp, id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        timestamp, id = dateutil.parser.isoparse(timestamp), int(id)
+    except Exception:
+        raise ChatError("分页游标错误", status=400)
+    # 游标可能被篡改：时间须带时区，id 须在数据库整数范围内
+    if timezone.is_naive(timestamp) or not 0 < id < 2**63:
+        raise ChatError("分页游标错误", status=400)
+    return Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=id)
+
+
+@api_view(["GET"])
+@authentication_classes([SessionAuthentication])
+@permission_classes([IsAuthenticated])
+async def session_messages_page(request, session_id):
+    try:
+        limit = int(request.query_params.get("limit", MESSAGE_PAGE_SIZE))
+    except ValueError:
+        return JsonResponse({"error": "limit 应为整数"}, status=400)
+    limit = max(1, min(limit, MESSAGE_PAGE_SIZE_MAX))
+
+    if not await Session.objects.filter(
+        id=session_id, user=request.user, deleted_time__isnull=True
+    ).aexists():
+        return JsonResponse({"error": "会话不存在"}, status=404)
+
+    messages = Message.objects.filter(session__id=session_id)
+    before = request.query_params.get("before")
+    if before:
+        try:
+            messages = messages.filter(__decode_message_cursor(before))
+        except ChatError as e:
+            serializer = ChatErrorSerializer(e)
+            return JsonResponse(serializer.data, status=e.status)
+
+    def load_page():
+        page = list(
+            messages.order_by("-timestamp", "-id").prefetch_related("blob_set")[
+                : limit + 1
+            ]
+        )
+        return page[:limit], len(page) > limit
+
+    page, has_more = await db_reader(load_page)()
+    data = await db_reader(
+        lambda messages: MessageSerializer(messages, many=True).data
+    )(page)
+    return JsonResponse(
+        {
+            "messages": data,
+            "before": __encode_message_cursor(page[-1]) if has_more else None,
+        }
+    )
+
+
+# 获取会话标题（后台生成标题时轮询）
+
+
+@api_view(["GET"])
+@authentication_classes([SessionAuthentication])
+@permission_classes([IsAuthenticated])
+async def session_title(request, session_id):
+    session = (
+        await Session.objects.filter(
+            id=session_id, user=request.user, deleted_time__isnull=True
+        )
+        .values("name", "title_pending")
+        .afirst()
+    )
+    if session is None:
+        return JsonResponse({"error": "会话不存在"}, status=404)
+    return JsonResponse(session)
+
+
 # 发送消息
 
+# 保存标题生成、流式请求等后台任务，防止任务在完成前被回收
+__background_tasks: set[asyncio.Task] = set()
 
+
+@DB_SECONDS.time(operation="get_last_messages")
 @transaction.atomic()
 def __get_last_messages(session):
     last_user_message_obj = (
@@ -191,10 +383,8 @@ async def __build_gpt_request(
     last_user_message_obj: Message,
     last_ai_message_obj: Message,
 ) -> GPTRequest:
-    try:
-        preference = await UserPreference.objects.aget(user=request.user)
-    except UserPreference.DoesNotExist:
-        raise ChatError("用户信息错误", status=404)
+    user_context = await aload_user_context(request)
+    preference = user_context.preference
 
     context = GPTContext()
 
@@ -206,13 +396,12 @@ async def __build_gpt_request(
 
     cont: bool = msg == "continue"
     regen: bool = msg == "%regenerate%"
-    permission = await check_usage(request.user)
 
     if regen:
         try:
             context.deadline = last_user_message_obj.timestamp
             msg = last_user_message_obj.content
-            images = await sync_to_async(
+            images = await db_reader(
                 lambda msg: list(
                     map(
                         lambda blob: blob.location,
@@ -243,6 +432,9 @@ async def __build_gpt_request(
     context.cont = cont
     context.image_urls = images
 
+    # 放在所有校验之后，避免请求无效时占用额度
+    permission = await check_usage(request.user, user_context.profile)
+
     gpt_request = GPTRequest(
         user=request.user,
         model_engine=model_engine,
@@ -255,6 +447,7 @@ async def __build_gpt_request(
     return gpt_request
 
 
+@DB_SECONDS.time(operation="save_new_request_rounds")
 @transaction.atomic()
 def __save_new_request_rounds(
     session: Session,
@@ -285,10 +478,12 @@ def __save_new_request_rounds(
         interrupted=context.cont,
         has_blob=len(context.image_urls) != 0,
         flag_qcmd=ai_message_obj.flag_qcmd,
+        content_tokens=estimate_text_tokens(context.msg),
     )
 
     ai_message_obj.session = session
     ai_message_obj.generation = context.generation
+    ai_message_obj.content_tokens = estimate_text_tokens(ai_message_obj.content)
     # 将返回消息加入数据库
     ai_message_obj.save()
 
@@ -302,59 +497,146 @@ def __save_new_request_rounds(
                 for image_url in context.image_urls
             ]
         )
+
+    # 构造输入时估算的历史消息token数
+    if gpt_request.counted_history:
+        Message.objects.bulk_update(gpt_request.counted_history, ["content_tokens"])
+
+    UsageRollup.record(ai_message_obj, gpt_request.permission.user_type)
+    # 轮数与最后回复时间变化
+    Session.objects.filter(id=session.id).update(modified_time=timezone.now())
     return user_message_obj, ai_message_obj
 
 
+async def __generate_title(session_id: int, msg: str) -> str:
+    """
+    后台生成会话标题并写入 Session.name，用户在此期间手动改名则放弃
+    Returns:
+        新的会话名，未改名时为空字符串
+    """
+    session_rename = ""
+    try:
+        re_success, re_resp = await summary_title(msg=msg)
+        if re_success:
+            session_rename = re_resp.strip()[:30]
+            renamed = await db_writer(
+                Session.objects.filter(id=session_id, is_renamed=False).update
+            )(
+                name=session_rename,
+                is_renamed=True,
+                title_pending=False,
+                modified_time=timezone.now(),
+            )
+            if not renamed:
+                session_rename = ""
+    except Exception as e:
+        logger.error(e)
+        session_rename = ""
+    finally:
+        await db_writer(
+            Session.objects.filter(id=session_id, title_pending=True).update
+        )(title_pending=False)
+    return session_rename
+
+
 async def __post_message(
     session_id: int,
     session: Session,
     preference: UserPreference,
     gpt_request: GPTRequest,
     gpt_response: Message,
-) -> str:
-    session_rename = ""
+) -> Optional[asyncio.Task]:
+    title_task = None
     context = gpt_request.context
     permission = gpt_request.permission
 
-    # 查看session是否进行过改名（再次filter防止同步问题）
-    if not gpt_response.flag_qcmd:
-        if (
-            not await Session.objects.filter(id=session_id)
-            .values_list("is_renamed", flat=True)
-            .afirst()
-        ) and preference.auto_generate_title:
-            re_success, re_resp = await summary_title(msg=context.msg)
-            if re_success:
-                session.name = re_resp
-                session_rename = re_resp
-                session.is_renamed = True
-                await session.asave()
-
-    if permission.student and not gpt_response.flag_qcmd:
-        await increase_usage(user=gpt_request.user)
-
-    # 增加次数，返回服务端生成的回复消息
-    return session_rename
+    # 会话未改名过时在后台生成标题（再次filter防止同步问题），不阻塞回复
+    if (
+        not gpt_response.flag_qcmd
+        and not session.is_renamed
+        and preference.auto_generate_title
+    ):
+        if await db_writer(
+            Session.objects.filter(id=session_id, is_renamed=False).update
+        )(title_pending=True):
+            title_task = asyncio.create_task(__generate_title(session_id, context.msg))
+            __background_tasks.add(title_task)
+            title_task.add_done_callback(__background_tasks.discard)
+
+    # 确认占用的额度（快捷指令不计入使用次数），返回标题生成任务
+    await __settle_quota(permission, charge=not gpt_response.flag_qcmd)
+    return title_task
+
+
+async def __quick_command(request) -> Optional[tuple[GPTRequest, Message]]:
+    """
+    快捷命令的快速路径：新消息匹配命令时直接得到回复，不读取历史消息、不占用额度
+    Returns:
+        (请求, 回复)，不是快捷命令时为None
+    """
+    msg: str = base64.b64decode(request.data.get("message")).decode()
+    if not msg.startswith("/"):
+        return None
 
+    model_engine: str = request.data.get("model")
+    if model_engine not in CHAT_MODELS:
+        raise ChatError("无模型匹配")
+    # 用户消息的时间需早于回复
+    request_time = timezone.now()
+    gpt_response = await handle_qcmd(msg, model_engine)
+    if gpt_response is None:
+        return None
 
-@api_view(["POST"])
-@authentication_classes([SessionAuthentication])
-@permission_classes([IsAuthenticated])
-async def send_message(request, session_id):
+    context = GPTContext()
+    context.msg = msg
+    context.request_time = request_time
+    context.deadline = request_time
+    context.generation = 1
+    context.regen = False
+    context.cont = False
+    context.image_urls = request.data.get("image_urls", [])
+
+    # 用户身份仅用于用量汇总，通常命中跨请求缓存
+    user_context = await aload_user_context(request)
+    user_type = user_context.profile.user_type
+    permission = GPTPermission(
+        student=user_type == "student", available=True, user_type=user_type
+    )
+
+    plugins = request.data.get("plugins")
+    gpt_request = GPTRequest(
+        user=request.user,
+        model_engine=model_engine,
+        permission=permission,
+        context=context,
+        preference=user_context.preference,
+        plugins=plugins if plugins is not None else [],
+    )
+    return gpt_request, gpt_response
+
+
+async def __prepare_send(
+    request, session_id: int
+) -> tuple[Session, UserPreference, GPTRequest, Optional[Message]]:
+    """
+    Returns:
+        (会话, 偏好设置, 请求, 快捷命令的回复)，不是快捷命令时回复为None
+    """
     try:
         session = await Session.objects.aget(
             id=session_id, user=request.user, deleted_time__isnull=True
         )
-
     except Session.DoesNotExist:
-        return JsonResponse({"error": "会话不存在"}, status=404)
+        raise ChatError("会话不存在", status=404)
 
-    try:
-        preference = await UserPreference.objects.aget(user=request.user)
-    except UserPreference.DoesNotExist:
-        raise ChatError("用户信息错误", status=404)
+    quick = await __quick_command(request)
+    if quick is not None:
+        gpt_request, gpt_response = quick
+        return session, gpt_request.preference, gpt_request, gpt_response
 
-    last_user_message_obj, last_ai_message_obj = await sync_to_async(
+    preference = (await aload_user_context(request)).preference
+
+    last_user_message_obj, last_ai_message_obj = await db_reader(
         __get_last_messages
     )(session)
 
@@ -362,86 +644,195 @@ async def send_message(request, session_id):
         request, last_user_message_obj, last_ai_message_obj
     )
 
-    try:
-        gpt_response = await handle_message(session=session, request=gpt_request)
+    return session, preference, gpt_request, None
 
-        user_message_obj, ai_message_obj = await sync_to_async(
-            __save_new_request_rounds
-        )(session, gpt_request, gpt_response)
 
-        session_rename = await __post_message(
-            session_id, session, preference, gpt_request, gpt_response
-        )
+async def __finish_send(
+    session_id: int,
+    session: Session,
+    preference: UserPreference,
+    gpt_request: GPTRequest,
+    gpt_response: Message,
+) -> tuple[dict, Optional[asyncio.Task]]:
+    user_message_obj, ai_message_obj = await db_writer(
+        __save_new_request_rounds
+    )(session, gpt_request, gpt_response)
 
-        return JsonResponse(
-            {
-                "message": ai_message_obj.content,
-                "flag_qcmd": ai_message_obj.flag_qcmd,
-                "use_model": ai_message_obj.use_model,
-                "send_timestamp": user_message_obj.timestamp.isoformat(),
-                "response_timestamp": ai_message_obj.timestamp.isoformat(),
-                "session_rename": session_rename,
-                "plugin_group": ai_message_obj.plugin_group,
-                "image_urls": gpt_request.context.image_urls,
-            }
+    title_task = await __post_message(
+        session_id, session, preference, gpt_request, gpt_response
+    )
+
+    return {
+        "message": ai_message_obj.content,
+        "flag_qcmd": ai_message_obj.flag_qcmd,
+        "use_model": ai_message_obj.use_model,
+        "send_timestamp": user_message_obj.timestamp.isoformat(),
+        "response_timestamp": ai_message_obj.timestamp.isoformat(),
+        # 标题在后台生成，title_pending 为真时通过 sessions/<id>/title/ 轮询
+        "session_rename": "",
+        "title_pending": title_task is not None,
+        "plugin_group": ai_message_obj.plugin_group,
+        "image_urls": gpt_request.context.image_urls,
+    }, title_task
+
+
+@api_view(["POST"])
+@authentication_classes([SessionAuthentication])
+@permission_classes([IsAuthenticated])
+async def send_message(request, session_id):
+    try:
+        session, preference, gpt_request, gpt_response = await __prepare_send(
+            request, session_id
         )
 
+        try:
+            if gpt_response is None:
+                gpt_response = await handle_message(
+                    session=session, request=gpt_request
+                )
+
+            data, _ = await __finish_send(
+                session_id, session, preference, gpt_request, gpt_response
+            )
+        finally:
+            # 未能完成时释放占用的额度
+            await __settle_quota(gpt_request.permission, charge=False)
+        return JsonResponse(data)
+
     except ChatError as e:
         serializer = ChatErrorSerializer(e)
         return JsonResponse(serializer.data, status=e.status)
 
 
-# 更新使用次数
-async def increase_usage(user):
-    try:
-        accounts = UserAccount.objects.filter(user=user)
-        await sync_to_async(accounts.update)(usage_count=F("usage_count") + 1)
-    except UserAccount.DoesNotExist:
-        raise ChatError("用户信息错误", status=404)
+# 流式发送消息（Server-Sent Events）
+# 事件: delta 增量文本; done 与 send_message 相同的完整回复; error 错误信息;
+# title 后台生成的会话标题（仅 done 中 title_pending 为真时发送）
 
 
-# 检查使用次数
-# 返回: GPTPermission(student: 是否为学生, available: 是否有消息余量)
+def __sse_event(event: str, data: dict) -> str:
+    return "event: {0}\ndata: {1}\n\n".format(
+        event, json.dumps(data, ensure_ascii=False)
+    )
 
 
-async def check_usage(user) -> GPTPermission:
+@api_view(["POST"])
+@authentication_classes([SessionAuthentication])
+@permission_classes([IsAuthenticated])
+async def send_message_stream(request, session_id):
     try:
-        profile = await UserProfile.objects.aget(user=user)
-        if profile.user_type != "student":
-            return GPTPermission(student=False, available=True)
+        session, preference, gpt_request, gpt_response = await __prepare_send(
+            request, session_id
+        )
+    except ChatError as e:
+        serializer = ChatErrorSerializer(e)
+        return JsonResponse(serializer.data, status=e.status)
 
-    except UserProfile.DoesNotExist:
-        raise ChatError("用户信息错误", status=404)
+    events: asyncio.Queue[Optional[str]] = asyncio.Queue()
 
-    try:
-        account = await UserAccount.objects.aget(user=user)
-        today = timezone.localtime(timezone.now()).date()
+    async def on_delta(delta: str):
+        events.put_nowait(__sse_event("delta", {"content": delta}))
 
-        if account.last_used != today:
-            account.usage_count = 0
-            account.last_used = today
-            await account.asave()
-            return GPTPermission(student=True, available=True)
+    async def respond(gpt_response: Optional[Message]):
+        # 客户端断开后仍然完成生成并保存，与 send_message 行为一致
+        try:
+            # 快捷命令已有完整回复，只发送 done
+            if gpt_response is None:
+                gpt_response = await handle_message(
+                    session=session, request=gpt_request, on_delta=on_delta
+                )
+            data, title_task = await __finish_send(
+                session_id, session, preference, gpt_request, gpt_response
+            )
+            events.put_nowait(__sse_event("done", data))
+            if title_task is not None:
+                events.put_nowait(
+                    __sse_event("title", {"name": await asyncio.shield(title_task)})
+                )
+        except ChatError as e:
+            data = {**ChatErrorSerializer(e).data, "status": e.status}
+            events.put_nowait(__sse_event("error", data))
+        except Exception as e:
+            logger.error(e)
+            events.put_nowait(
+                __sse_event("error", {"error": "服务器遇到未知错误", "status": 500})
+            )
+        finally:
+            await __settle_quota(gpt_request.permission, charge=False)
+            events.put_nowait(None)
 
-        if account.usage_count >= STUDENT_LIMIT:
-            return GPTPermission(student=True, available=False)
-        else:
-            return GPTPermission(student=True, available=True)
+    task = asyncio.create_task(respond(gpt_response))
+    __background_tasks.add(task)
+    task.add_done_callback(__background_tasks.discard)
+
+    async def stream():
+        while (event := await events.get()) is not None:
+            yield event
+
+    response = StreamingHttpResponse(stream(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+# 确认或释放占用的额度，可重复调用
+
+
+async def __settle_quota(permission: GPTPermission, charge: bool):
+    reservation, permission.reservation = permission.reservation, None
+    if reservation is None:
+        return
+    if charge:
+        quota_ledger.commit(reservation)
+    else:
+        await quota_ledger.release(reservation)
+
+
+# 检查使用次数，学生账户同时原子地占用一次额度
+# 返回: GPTPermission(student: 是否为学生, available: 是否有消息余量)
 
-    except UserAccount.DoesNotExist:
-        raise ChatError("用户信息错误", status=404)
+
+@DB_SECONDS.time(operation="check_usage")
+async def check_usage(user, profile: UserProfile) -> GPTPermission:
+    if profile.user_type != "student":
+        return GPTPermission(
+            student=False, available=True, user_type=profile.user_type
+        )
+
+    try:
+        reservation = await quota_ledger.reserve(user.id)
+        return GPTPermission(
+            student=True,
+            available=reservation is not None,
+            user_type=profile.user_type,
+            reservation=reservation,
+        )
+
+    except ChatError:
+        raise
 
     except Exception as e:
         raise ChatError(e.__str__(), status=500)
 
 
+# 允许通过 PATCH 修改的偏好设置
+__PREFERENCE_FIELDS = {
+    field.name
+    for field in UserPreference._meta.concrete_fields
+    if not field.primary_key and not field.is_relation
+}
+
+
 @api_view(["GET", "PATCH"])
 @authentication_classes([SessionAuthentication])
 @permission_classes([IsAuthenticated])
 async def user_preference(request):
-    preference = await UserPreference.objects.aget(user=request.user)
-
     if request.method == "GET":
+        try:
+            preference = (await aload_user_context(request)).preference
+        except ChatError as e:
+            serializer = ChatErrorSerializer(e)
+            return JsonResponse(serializer.data, status=e.status)
+
         serializer = UserPreferenceSerializer(preference)
         return JsonResponse(serializer.data)
 
@@ -452,17 +843,26 @@ async def user_preference(request):
         if field is None or value is None:
             return JsonResponse({"error": "缺少参数"}, status=400)
 
-        if field not in preference.__dict__.keys():
+        if field not in __PREFERENCE_FIELDS:
             return JsonResponse({"error": "修改域不存在"}, status=400)
 
+        # 缓存中的副本可能已过时，修改时从数据库读取并只保存修改的域
+        try:
+            preference = await db_reader(UserPreference.objects.get)(
+                user=request.user
+            )
+        except UserPreference.DoesNotExist:
+            return JsonResponse({"error": "用户信息错误"}, status=404)
+
         setattr(preference, field, value)
 
         try:
-            await sync_to_async(preference.full_clean)()
+            await db_reader(preference.full_clean)()
         except ValidationError:
             return JsonResponse({"error": "修改域不合法"}, status=400)
 
-        await preference.asave()
+        await db_writer(preference.save)(update_fields=[field])
+        invalidate_user_context(request.user.id)
         serializer = UserPreferenceSerializer(preference)
         return JsonResponse(serializer.data)
 
@@ -495,15 +895,17 @@ async def share_session(request, session_id):
     except Exception:
         return JsonResponse({"error": "分享时间格式错误"}, status=400)
 
-    messages = await sync_to_async(
+    messages = await db_reader(
         lambda session: Message.objects.filter(session=session)
         .order_by("timestamp")
-        .all()
+        .prefetch_related("blob_set")
     )(session)
 
-    messages = await sync_to_async(
+    messages = await db_reader(
         lambda messages: MessageSerializer(messages, many=True).data
     )(messages)
+    for message in messages:
+        message.pop("id")
 
     snapshot = json.dumps(
         {"username": request.user.username, "name": session.name, "messages": messages}
@@ -522,7 +924,7 @@ async def share_session(request, session_id):
                 ),
                 signed=False,
             )
-            await SessionShared.objects.acreate(
+            await db_writer(SessionShared.objects.create)(
                 session=session, deadline=deadline, share_id=share_id, snapshot=snapshot
             )
             break
@@ -579,6 +981,7 @@ async def save_shared_session(request):
     def create_fork(snapshot: dict):
         def strip(message: dict):
             message.pop("time")
+            message.pop("id", None)
             return message
 
         session = Session.objects.create(
@@ -598,8 +1001,8 @@ async def save_shared_session(request):
                 )
         return session
 
-    session = await sync_to_async(create_fork)(snapshot)
-    data = await sync_to_async(lambda session: SessionSerializer(session).data)(session)
+    session = await db_writer(create_fork)(snapshot)
+    data = await db_reader(lambda session: SessionSerializer(session).data)(session)
     return JsonResponse(data, safe=False)
 
 
@@ -614,3 +1017,82 @@ async def list_models(request):
         },
         status=200,
     )
+
+
+# 运行时统计（仅管理员）
+
+
+@api_view(["GET"])
+@authentication_classes([SessionAuthentication])
+@permission_classes([IsAdminUser])
+async def runtime_stats(request):
+    return JsonResponse(
+        {
+            "completion_cache": completion_cache.stats(),
+            "inflight_requests": inflight_requests.stats(),
+            "providers": provider_guards.stats(),
+            "routing": backend_router.stats(),
+            "qcmd_cache": qcmd_cache.stats(),
+        },
+        status=200,
+    )
+
+
+# 用量汇总（仅管理员），参数 since/until 为 YYYY-MM-DD，默认最近30天
+
+
+@api_view(["GET"])
+@authentication_classes([SessionAuthentication])
+@permission_classes([IsAdminUser])
+async def usage_rollups(request):
+    today = timezone.localdate()
+    try:
+        since = datetime.date.fromisoformat(
+            request.query_params.get("since")
+            or (today - datetime.timedelta(days=29)).isoformat()
+        )
+        until = datetime.date.fromisoformat(
+            request.query_params.get("until") or today.isoformat()
+        )
+    except ValueError:
+        return JsonResponse({"error": "日期格式应为 YYYY-MM-DD"}, status=400)
+
+    rollups = UsageRollup.objects.filter(day__gte=since, day__lte=until)
+    totals = {
+        "llm_messages": Sum("llm_messages"),
+        "qcmd_messages": Sum("qcmd_messages"),
+        "prompt_tokens": Sum("prompt_tokens"),
+        "completion_tokens": Sum("completion_tokens"),
+    }
+
+    def query(*fields: str) -> list[dict]:
+        return list(rollups.values(*fields).annotate(**totals).order_by(*fields))
+
+    data = {
+        "since": since.isoformat(),
+        "until": until.isoformat(),
+        "by_day": await db_reader(query)("day"),
+        "by_model": await db_reader(query)("model"),
+        "by_user_type": await db_reader(query)("user_type"),
+    }
+    for row in data["by_day"]:
+        row["day"] = row["day"].isoformat()
+    return JsonResponse(data, status=200)
+
+
+# Prometheus指标，使用 METRICS_TOKEN（Bearer）或管理员登录访问
+
+
+@api_view(["GET"])
+@authentication_classes([SessionAuthentication])
+@permission_classes([AllowAny])
+async def metrics(request):
+    authorization = request.headers.get("Authorization", "")
+    authorized = METRICS_TOKEN is not None and hmac.compare_digest(
+        authorization.encode(), "Bearer {0}".format(METRICS_TOKEN).encode()
+    )
+    if not authorized and not await db_reader(lambda: request.user.is_staff)():
+        return JsonResponse({"error": "无权限"}, status=403)
+    return HttpResponse(
+        metrics_registry.expose(), content_type="text/plain; version=0.0.4"
+    )
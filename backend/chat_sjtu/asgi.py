@@ -3,6 +3,13 @@ ASGI config for chat_sjtu project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serve it with a server that implements the ASGI lifespan protocol, e.g.
+``uvicorn chat_sjtu.asgi:application`` or gunicorn with
+``-k uvicorn.workers.UvicornWorker``, so connection pools are warmed before the
+first request and closed (and pending usage flushed) on shutdown. Daphne and
+``manage.py runserver`` do not send lifespan events; see chat_sjtu/lifespan.py
+for how the hooks run there.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
@@ -15,4 +22,25 @@ dotenv.load_dotenv(verbose=True)
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chat_sjtu.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from chat.core.gpt import provider_registry  # noqa: E402
+from chat.core.plugins.fc import fc_session  # noqa: E402
+from chat.core.plugins.qcmd import qcmd_session  # noqa: E402
+from chat.core.configs import SERVER_WORKERS  # noqa: E402
+from chat.core.quota import quota_ledger  # noqa: E402
+from chat_sjtu.lifespan import LifespanApplication  # noqa: E402
+
+# 只在服务进程中检查，migrate 等管理命令不受 WEB_CONCURRENCY 影响
+quota_ledger.check_deployment(SERVER_WORKERS)
+
+application = LifespanApplication(
+    django_application,
+    startup=[provider_registry.warmup, fc_session.open, qcmd_session.open],
+    shutdown=[
+        provider_registry.aclose,
+        fc_session.aclose,
+        qcmd_session.aclose,
+        quota_ledger.aclose,
+    ],
+)
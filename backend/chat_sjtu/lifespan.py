@@ -0,0 +1,118 @@
+"""
+ASGI lifespan support for chat_sjtu project.
+
+Django's ASGI handler only speaks HTTP, so ``LifespanApplication`` answers the
+``lifespan`` scope itself and runs the registered startup / shutdown hooks
+(e.g. warming and closing process-wide HTTP connection pools) before
+delegating every other scope to the wrapped application.
+
+Servers that implement the lifespan protocol (uvicorn, hypercorn, gunicorn with
+``uvicorn.workers.UvicornWorker``) drive the hooks directly. Daphne (used by
+``manage.py runserver`` because it is in INSTALLED_APPS) never sends the
+``lifespan`` scope, so the startup hooks run before the first request instead,
+and the shutdown hooks are registered on the Twisted reactor's shutdown
+trigger, or with ``atexit`` when no reactor is running.
+"""
+
+from typing import Awaitable, Callable, Iterable, Optional
+import asyncio
+import atexit
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+
+Hook = Callable[[], Awaitable[None]]
+
+
+class LifespanApplication:
+    def __init__(
+        self,
+        app,
+        startup: Iterable[Hook] = (),
+        shutdown: Iterable[Hook] = (),
+    ):
+        self.app = app
+        self.startup = list(startup)
+        self.shutdown = list(shutdown)
+        self.__started = False
+        self.__stopped = False
+        self.__starting: Optional[asyncio.Lock] = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "lifespan":
+            if not self.__started:
+                await self.__lazy_startup()
+            return await self.app(scope, receive, send)
+
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self.__startup()
+                except Exception as e:
+                    logger.exception("Lifespan startup failed")
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+
+            elif message["type"] == "lifespan.shutdown":
+                await self.__shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def __startup(self):
+        for hook in self.startup:
+            await hook()
+        self.__started = True
+
+    async def __shutdown(self):
+        if self.__stopped:
+            return
+        self.__stopped = True
+        for hook in self.shutdown:
+            try:
+                await hook()
+            except Exception:
+                logger.exception("Lifespan shutdown hook failed")
+
+    async def __lazy_startup(self):
+        """服务器不支持 lifespan 时，在第一个请求前执行启动钩子并注册关闭钩子"""
+        if self.__starting is None:
+            self.__starting = asyncio.Lock()
+        async with self.__starting:
+            if self.__started:
+                return
+            try:
+                await self.__startup()
+            except Exception:
+                # 启动钩子只做预热，失败时不影响请求，各资源在首次使用时创建
+                logger.exception("Lazy startup failed")
+                self.__started = True
+            self.__register_shutdown(asyncio.get_running_loop())
+
+    def __register_shutdown(self, loop: asyncio.AbstractEventLoop):
+        reactor = sys.modules.get("twisted.internet.reactor")
+        if reactor is not None and getattr(reactor, "running", False):
+            # daphne：在 reactor 停止前、事件循环仍在运行时执行
+            from twisted.internet import defer
+
+            reactor.addSystemEventTrigger(
+                "before",
+                "shutdown",
+                lambda: defer.Deferred.fromFuture(
+                    asyncio.ensure_future(self.__shutdown())
+                ),
+            )
+            return
+
+        def shutdown_at_exit():
+            if loop.is_running():
+                logger.warning("Event loop still running, shutdown hooks skipped")
+            elif loop.is_closed():
+                # 原事件循环已关闭（如 asyncio.run 结束），在新的事件循环中执行
+                asyncio.run(self.__shutdown())
+            else:
+                loop.run_until_complete(self.__shutdown())
+
+        atexit.register(shutdown_at_exit)
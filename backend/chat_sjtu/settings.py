@@ -73,6 +73,11 @@ LOGGING = {
             'handlers': ['console'],
             'level': 'WARNING',
             'propagate': True
+        },
+        'httpx': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': True
         }
     },
 }
@@ -135,9 +140,33 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # 等待锁释放的时间（秒），超时才报 database is locked
+            'timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 20)),
+        },
     }
 }
 
+# SQLite生产模式：WAL与pragma、串行化写操作，见 chat/core/db.py
+SQLITE_PRODUCTION = os.environ.get('SQLITE_PRODUCTION', '0') == '1'
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # 用量计数（chat/core/quota.py），多进程部署（WEB_CONCURRENCY>1）时必须改为共享后端（如Redis）
+    'quota': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'quota',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+    # 快捷命令的校园数据（chat/core/plugins/qcmd/staleCache.py），共享后端可让各进程共用
+    'qcmd': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'qcmd',
+    },
+}
+
 SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
 
 # Password validation
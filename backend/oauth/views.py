@@ -15,6 +15,9 @@ from oauth.utils import *
 from oauth.models import UserProfile
 from chat.models import *
 from chat.views import STUDENT_LIMIT
+from chat.core.quota import quota_ledger
+from chat.core.user_context import load_user_context, invalidate_user_context
+from chat.core.errors import ChatError
 from chat_sjtu.settings import CSRF_TRUSTED_ORIGINS
 
 # @api_view(['POST'])
@@ -82,6 +85,7 @@ def auth_jaccount(request):
     UserProfile.objects.update_or_create(user=user, defaults={'user_type': user_type})
     UserAccount.objects.update_or_create(user=user)
     UserPreference.objects.update_or_create(user=user)
+    invalidate_user_context(user.id)
     if user:
         login(request, user)
         if created:
@@ -96,21 +100,15 @@ def auth_jaccount(request):
 def get_user_info(request):
     try:
         user = request.user
-        profile = UserProfile.objects.get(user=request.user)
-        account = UserAccount.objects.get(user=request.user)
-        today = timezone.localtime(timezone.now()).date()
-        if account.last_used != today:
-            account.usage_count = 0
-            account.last_used = today
-            account.save()
+        profile = load_user_context(request).profile
         user_data = {
             'username': user.username,
             'usertype': profile.user_type,
-            'usagecount': account.usage_count,
+            'usagecount': quota_ledger.usage(user.id),
             'usagelimit': STUDENT_LIMIT if profile.user_type=='student' else -1
         }
         return JsonResponse(user_data)
-    except User.DoesNotExist:
+    except (User.DoesNotExist, UserAccount.DoesNotExist, ChatError):
         return JsonResponse({'error': 'User does not exist'}, status=404)
 
 # 登出
@@ -134,6 +132,7 @@ def logout_and_delete_user(request):
         profile.delete()
         preference = UserPreference.objects.get(user=request.user)
         preference.delete()
+        invalidate_user_context(request.user.id)
 
         logout(request)
         return JsonResponse({'message': 'User deleted and logged out successfully'})
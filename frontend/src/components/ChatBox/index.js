@@ -214,6 +214,10 @@ function ChatBox({ onChangeSessionInfo, onChangeComponent, curRightComponent}) {
                 'rounds': reqSession.rounds + 1,
                 'updated_time': responseTime.toLocaleString('default', timeOptions),
             });
+            //会话名在后台生成，轮询获取
+            if (response.data.title_pending) {
+                pollSessionTitle(reqSession.id);
+            }
 
         } catch (error) {
             console.error('Failed to send message:', error);
@@ -234,6 +238,23 @@ function ChatBox({ onChangeSessionInfo, onChangeComponent, curRightComponent}) {
         }
     };
     
+    //轮询后台生成的会话名
+    const pollSessionTitle = async (sessionId, retries = 10) => {
+        for (let i = 0; i < retries; i++) {
+            await new Promise((resolve) => setTimeout(resolve, 1000));
+            try {
+                const response = await request.get(`/api/sessions/${sessionId}/title/`);
+                if (!response.data.title_pending) {
+                    onChangeSessionInfo(sessionId, {name: response.data.name});
+                    return;
+                }
+            } catch (error) {
+                console.error('Failed to fetch session title:', error);
+                return;
+            }
+        }
+    };
+
     //重试发送
     const handleRetry = async () => {
         if (retryMessage) {